@@ -1,44 +1,332 @@
 import pygame
 import requests
+import numpy as np
 import sys
 import os
 from io import BytesIO
-from math import pi, sin, atan2, sqrt, cos, radians
+from urllib.parse import urlsplit
+from math import pi, cos, radians
 from PyQt5.QtWidgets import QWidget, QInputDialog, QMainWindow, QApplication, QFileDialog
-import csv
+import hashlib
+import struct
+import mmap
+import sqlite3
+import json
+import argparse
+import time
+import copy
+import threading
+import multiprocessing
+from collections import OrderedDict, deque
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future, as_completed
 from PIL import Image, ImageDraw, ImageFont
 import xml.etree.ElementTree as ET
 
 LAT_STEP = 0.0035  # Шаги при движении карты по широте и долготе
 LON_STEP = 0.007
 
+ROUTE_COLORS = [(0, 160, 96), (200, 40, 40), (40, 80, 220), (230, 140, 0), (150, 40, 180),
+                (0, 150, 170), (120, 90, 40), (220, 60, 150), (90, 120, 30), (60, 60, 60)]  # цвета маршрутов по очереди
+CHUNK = 128  # точек в куске маршрута, невидимые куски не пересчитываются
+CLICK_RADIUS = 8  # на сколько пикселей можно промахнуться мимо точки маршрута
+STOP_SPEED = 1.5  # медленнее, км/ч, - стоянка (дрожание GPS на месте)
+PLAY_SPEED = 60  # проигрывание маршрута во столько раз быстрее, чем было
+
+TILE = 256  # размер куска карты (Web-Mercator, z/x/y), px
+MAX_LAT = 85.05112878  # дальше к полюсам у Web-Mercator кусков нет
+TILE_URL = 'https://tile.openstreetmap.org/{z}/{x}/{y}.png'  # источник по умолчанию
+# общие сервера, правила которых запрещают массовую загрузку: с них - только то, что на экране
+NO_BULK_HOSTS = ('tile.openstreetmap.org',)
+VIEW_W, VIEW_H = 1080, 900  # область карты на экране
+
+CACHE_DIR = 'cache'  # каталог дискового кэша кусков карты
+CACHE_MEM_TILES = 256  # сколько кусков держать в памяти (вид - около 30)
+CACHE_DISK_BYTES = 200 * 1024 * 1024  # предельный размер дискового кэша
+SURFACE_POOL_BYTES = 64 * 1024 * 1024  # пиксели готовых к выводу кусков (кусок - 256 КБ, всего около 250)
+FONT_FILE = 'fonts/arial.ttf'  # шрифт надписей
+TEXT_CACHE = 256  # сколько готовых надписей помнить
+SEED_TILE_BYTES = 20 * 1024  # средний размер куска для оценки, пока в кэше мало своих
+ROUTE_CACHE_DIR = os.path.join(CACHE_DIR, 'routes')  # двоичные копии прочитанных маршрутов
+ROUTE_LEVELS = range(5, 20)  # масштабы, для которых храним упрощённый маршрут
+
+session = requests.Session()  # одно соединение keep-alive на все запросы карт
+session.headers['User-Agent'] = 'Map_route/1.0'  # без него сервера OSM не отдают куски
+map_pool = ThreadPoolExecutor(max_workers=6)  # куски карты грузим одновременно
+fonts = {}  # (файл, размер) -> шрифт: файл читается один раз
+texts = OrderedDict()  # (текст, размер, цвет, файл) -> готовая надпись, последние в конце
+
+GEOCODER_URL = 'http://geocode-maps.yandex.ru/1.x/'  # можно подменить, например, локальной заглушкой
+GEOCODER_KEY = '40d1649f-0493-4b70-98ba-98533de7710b'
+GEOCODER_RATE = 5  # не больше запросов в секунду
+GEOCODER_TTL = 30 * 24 * 3600  # сколько помнить ответ, с
+GEOCODER_CACHE = 4096  # сколько ответов помнить
+GEOCODE_EVERY = 0  # адреса каждой N-й точки загруженного маршрута заранее, 0 - не запрашивать
+GEOCODED = pygame.USEREVENT + 1  # событие: адрес точки клика получен
+TILE_LOADED = pygame.USEREVENT + 2  # событие: кусок карты загружен
+PROFILE_TRACE = 'trace.json'  # куда записать трассировку (F3), открывается в chrome://tracing или Perfetto
+PROFILE_EVENTS = 200000  # сколько последних отрезков трассировки помнить
+
+
+# Замер одного этапа: with profiler.span('route'): ...
+class Span:
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.profiler.add(self.name, self.start, time.perf_counter())
+
+
+# Замеры времени по этапам и счётчики (байты из сети, попадания в кэш) - для панели (F2) и файла трассировки (F3).
+# Выключен - span() отдаёт пустой контекст, а count() сразу возвращается
+class Profiler:
+    NO_SPAN = nullcontext()
 
-# Найти объект по координатам
-def reverse_geocode(ll):
-    geocoder_request_template = "http://geocode-maps.yandex.ru/1.x/?apikey=" \
-                                "40d1649f-0493-4b70-98ba-98533de7710b&geocode={ll}&format=json"
+    def __init__(self):
+        self.enabled = False  # показывать на панели
+        self.tracing = False  # записывать отрезки для файла
+        self.stages = {}  # этап -> мс с конца прошлого кадра (и из фоновых потоков)
+        self.counters = {}  # счётчик -> значение с конца прошлого кадра
+        self.last = (0.0, {}, {})  # прошлый кадр: время, этапы, счётчики
+        self.events = deque(maxlen=PROFILE_EVENTS)  # (этап, начало, конец, поток)
+        self.lock = threading.Lock()  # этапы приходят и из потоков загрузки
+
+    @property
+    def active(self):
+        return self.enabled or self.tracing
+
+    def span(self, name):
+        return Span(self, name) if self.active else self.NO_SPAN
+
+    def add(self, name, start, end):
+        with self.lock:
+            self.stages[name] = self.stages.get(name, 0.0) + (end - start) * 1000
+            if self.tracing:
+                self.events.append((name, start, end, threading.get_ident()))
+
+    def count(self, name, value=1):
+        if self.active:
+            with self.lock:
+                self.counters[name] = self.counters.get(name, 0) + value
+
+    # начало кадра: момент или 0, если замеры выключены
+    def begin_frame(self):
+        return time.perf_counter() if self.active else 0
+
+    # конец кадра, начатого в <start>: накопленное переходит в прошлый кадр
+    def end_frame(self, start):
+        if not start:
+            return
+        end = time.perf_counter()
+        with self.lock:
+            if self.tracing:
+                self.events.append(('frame', start, end, threading.get_ident()))
+            self.last = ((end - start) * 1000, self.stages, self.counters)
+            self.stages, self.counters = {}, {}
+
+    # трассировка вкл/выкл; при выключении - запись в <fname>, возвращает имя файла
+    def toggle_trace(self, fname=PROFILE_TRACE):
+        if not self.tracing:
+            self.events.clear()
+            self.tracing = True
+            return None
+        self.tracing = False
+        return self.save(fname)
+
+    # формат Trace Event (JSON): отрезки "X" с началом и длительностью в мкс
+    def save(self, fname):
+        with self.lock:
+            events = list(self.events)
+        pid = os.getpid()
+        trace = [{"name": name, "ph": "X", "ts": start * 1e6, "dur": (end - start) * 1e6, "pid": pid, "tid": tid}
+                 for name, start, end, tid in events]
+        with open(fname, 'w', encoding='utf-8') as f:
+            json.dump({"traceEvents": trace, "displayTimeUnit": "ms"}, f)
+        return fname
+
+    # строки для панели: время кадра, самые долгие этапы, сеть и кэш
+    def lines(self, stages=5):
+        frame_ms, times, counters = self.last
+        lines = [f"кадр {frame_ms:.1f} мс"]
+        for name, ms in sorted(times.items(), key=lambda item: -item[1])[:stages]:
+            lines.append(f"{name} {ms:.1f}")
+        lines.append(f"сеть {counters.get('net_bytes', 0) / 1024:.0f} КБ")
+        lines.append(f"кэш {counters.get('tile_hit', 0)}/{counters.get('tile_miss', 0)}")
+        return lines
+
+
+profiler = Profiler()  # выключен, пока не нажаты F2 или F3
+
+
+# Ограничение частоты запросов: «ведро» на <burst> жетонов, пополняется <rate> жетонами в секунду
+class TokenBucket:
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or rate
+        self.tokens = self.capacity
+        self.stamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    # взять жетон, если их нет - подождать
+    def take(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+                self.stamp = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+# адрес и координаты из топонима ответа геокодера
+def toponym_address(toponym):
+    return toponym["metaDataProperty"]["GeocoderMetaData"]["text"]
+
+
+def toponym_coord(toponym):
+    lon, lat = toponym["Point"]["pos"].split()
+    return float(lon), float(lat)
 
-    # Выполняем запрос к геокодеру, анализируем ответ
-    geocoder_request = geocoder_request_template.format(**locals())
-    response = requests.get(geocoder_request)
 
-    if not response:
-        raise RuntimeError("""Ошибка выполнения запроса: {request} Http статус: {status} ({reason})""".format(
-                request=geocoder_request, status=response.status_code, reason=response.reason))
+# Геокодер: запросы в фоновых потоках (результат - Future), ответы помнятся (LRU со сроком, на диске между
+# запусками), одинаковые одновременные запросы объединяются, частота ограничена
+class Geocoder:
+    def __init__(self, url=GEOCODER_URL, apikey=GEOCODER_KEY, rate=GEOCODER_RATE, ttl=GEOCODER_TTL,
+                 size=GEOCODER_CACHE, path=os.path.join(CACHE_DIR, 'geocode.json')):
+        self.url = url
+        self.apikey = apikey
+        self.ttl = ttl
+        self.size = size
+        self.path = path
+        self.cache = OrderedDict()  # ключ -> (срок годности, ответ), последние в конце
+        self.pending = {}  # ключ -> Future запроса, который уже выполняется
+        self.lock = threading.Lock()
+        self.bucket = TokenBucket(rate)
+        self.pool = ThreadPoolExecutor(max_workers=2)  # клики и ввод адреса
+        self.batch_pool = ThreadPoolExecutor(max_workers=1)  # точки маршрутов - не мешают кликам
+        self.hits = 0
+        self.requests = 0
+        self.load()
+
+    # ключи: координаты до 4 знаков (около 10 м), адрес без регистра, запятых и лишних пробелов
+    @staticmethod
+    def point_key(lon, lat):
+        return f"{lon:.4f},{lat:.4f}"
+
+    @staticmethod
+    def address_key(address):
+        return 'адрес:' + ' '.join(address.lower().replace(',', ' ').split())
+
+    # адрес точки (Future со строкой или None)
+    def reverse(self, lon, lat, batch=False):
+        return self.submit(self.point_key(lon, lat), ll(lon, lat), toponym_address,
+                           self.batch_pool if batch else self.pool)
+
+    # координаты адреса (Future с (lon, lat) или None)
+    def geocode(self, address):
+        return self.submit(self.address_key(address), address, toponym_coord, self.pool)
+
+    # адреса каждой <every>-й точки маршрута в фоне: индекс точки -> Future
+    def reverse_track(self, track, every):
+        return {i: self.reverse(track.lon[i], track.lat[i], batch=True) for i in range(0, len(track.lon), every)}
+
+    def submit(self, key, query, parse, pool):
+        with self.lock:
+            item = self.cache.get(key)
+            if item and item[0] > time.time():
+                self.cache.move_to_end(key)
+                self.hits += 1
+                future = Future()
+                future.set_result(item[1])
+                return future
+            future = self.pending.get(key)
+            if future is None or future.cancelled():
+                future = pool.submit(self.fetch, key, query, parse)
+                self.pending[key] = future
+            return future
+
+    def fetch(self, key, query, parse):
+        try:
+            self.bucket.take()
+            self.requests += 1
+            with profiler.span('geocode'):
+                response = session.get(self.url, params={"apikey": self.apikey, "geocode": query, "format": "json"},
+                                       timeout=10)
+            profiler.count('net_bytes', len(response.content))
+            if not response:
+                raise RuntimeError("""Ошибка выполнения запроса: {request} Http статус: {status} ({reason})""".format(
+                        request=response.url, status=response.status_code, reason=response.reason))
+            features = response.json()["response"]["GeoObjectCollection"]["featureMember"]
+            value = parse(features[0]["GeoObject"]) if features else None
+            with self.lock:
+                self.cache[key] = (time.time() + self.ttl, value)
+                self.cache.move_to_end(key)
+                while len(self.cache) > self.size:
+                    self.cache.popitem(last=False)
+            return value
+        finally:
+            with self.lock:
+                self.pending.pop(key, None)
+
+    def load(self):
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                items = json.load(f)
+        except (OSError, ValueError):
+            return
+        now = time.time()
+        try:
+            for key, (expires, value) in items:
+                if expires > now:
+                    self.cache[key] = (expires, tuple(value) if isinstance(value, list) else value)
+        except (ValueError, TypeError):
+            print('Файл адресов испорчен, не используется:', self.path)
+            self.cache.clear()
+
+    def save(self):
+        with self.lock:
+            items = list(self.cache.items())
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path, 'w', encoding='utf-8') as f:
+                json.dump(items, f, ensure_ascii=False)
+        except OSError as e:
+            print('Не удалось сохранить адреса', self.path, e)
 
-    # Преобразуем ответ в json-объект
-    json_response = response.json()
-    # pprint.pprint(json_response)
+    # при выходе: запомнить ответы и не ждать ещё не начатых фоновых запросов
+    def close(self):
+        self.save()
+        self.pool.shutdown(wait=False, cancel_futures=True)
+        self.batch_pool.shutdown(wait=False, cancel_futures=True)
 
-    # Получаем первый топоним из ответа геокодера
-    features = json_response["response"]["GeoObjectCollection"]["featureMember"]
-    return features[0]["GeoObject"] if features else None
+    def stats(self):
+        return f"из памяти {self.hits}, запросов {self.requests}"
 
 
 def ll(x, y):
     return f"{x},{y}"
 
 
+# Web-Mercator: географические координаты -> пиксели всего мира на масштабе <zoom> (числа или массивы)
+def world_xy(lon, lat, zoom):
+    size = TILE * 2 ** zoom
+    s = np.sin(np.radians(lat))
+    return (lon + 180) / 360 * size, (0.5 - np.log((1 + s) / (1 - s)) / (4 * pi)) * size
+
+
+# и обратно: пиксели мира -> lon, lat
+def world_lonlat(x, y, zoom):
+    size = TILE * 2 ** zoom
+    return x / size * 360 - 180, np.degrees(np.arctan(np.sinh(pi * (1 - 2 * y / size))))
+
+
 class SearchResult:
     def __init__(self, point, address):
         self.point = point
@@ -50,12 +338,9 @@ class Map:
         self.lat = None  # координаты центра всей карты
         self.lon = None
         self.zoom = 15
-        self.type = "map"
         self.search_result = None
-        self.lonlat4 = [(None, None)] * 4  # координаты центров 4-х частей
-
-    def lonlat(self):
-        return ll(self.lon, self.lat)
+        self.search_id = 0  # номер последнего клика: ответ на прежний уже не показываем
+        self.big_step = False  # стрелки двигают карту в 4 раза дальше
 
     def correct_lon(self):
         if self.lon > 180:
@@ -63,178 +348,582 @@ class Map:
         if self.lon < -180:
             self.lon += 360
 
-    def map_size(self):
-        # размеры куска карты (600х450 px) в градусах долготы и широты (важна широта)
-        dlon = 0.02575 * (2 ** (15 - self.zoom))  # как под 600 pixels
-        dlat = cos(radians(self.lat)) * 0.01933 * (2 ** (15 - self.zoom))
-        # плотность: по горизонтали dlon/600, по вертикали dlat/450
-        return dlon, dlat
-
-    # Обновление параметров карты по нажатой клавише
-    def update(self, key_code):
+    def correct_lat(self):
+        self.lat = min(max(self.lat, -MAX_LAT), MAX_LAT)
+
+    # пиксели мира, которые приходятся на левый верхний угол карты на экране
+    def origin(self):
+        cx, cy = world_xy(self.lon, self.lat, self.zoom)
+        return int(round(float(cx))) - VIEW_W // 2, int(round(float(cy))) - VIEW_H // 2
+
+    # куски, покрывающие экран: (z, x, y, экранный x, экранный y)
+    def tiles(self):
+        left, top = self.origin()
+        n = 2 ** self.zoom
+        result = []
+        for ty in range(top // TILE, (top + VIEW_H - 1) // TILE + 1):
+            if 0 <= ty < n:
+                for tx in range(left // TILE, (left + VIEW_W - 1) // TILE + 1):
+                    result.append((self.zoom, tx % n, ty, tx * TILE - left, ty * TILE - top))
+        return result
+
+    def map_size(self, lat=None):
+        # размеры области 600х450 px в градусах долготы и широты (важна широта)
+        if lat is None:
+            lat = self.lat
+        deg = 360 / (TILE * 2 ** self.zoom)  # градусов долготы в пикселе
+        return 600 * deg, 450 * deg * cos(radians(lat))
+
+    # Изменение параметров карты по нажатой клавише (без загрузки), True - вид изменился
+    def step(self, key_code):
         if key_code == pygame.K_PAGEUP and self.zoom < 19:
             self.zoom += 1
         elif key_code == pygame.K_PAGEDOWN and self.zoom > 5:
             self.zoom -= 1
         elif key_code == pygame.K_LEFT:
             d_lon = LON_STEP * (2 ** (15 - self.zoom))
-            if BigStep:
+            if self.big_step:
                 d_lon *= 4
             self.lon -= d_lon
             self.correct_lon()
         elif key_code == pygame.K_RIGHT:
             d_lon = LON_STEP * (2 ** (15 - self.zoom))
-            if BigStep:
+            if self.big_step:
                 d_lon *= 4
             self.lon += d_lon
             self.correct_lon()
         elif key_code == pygame.K_UP and self.lat < 75:
             d_lat = LAT_STEP * (2 ** (15 - self.zoom))
-            if BigStep:
+            if self.big_step:
                 d_lat *= 4
             self.lat += d_lat
+            self.correct_lat()
         elif key_code == pygame.K_DOWN and self.lat > -40:
             d_lat = LAT_STEP * (2 ** (15 - self.zoom))
-            if BigStep:
+            if self.big_step:
                 d_lat *= 4
             self.lat -= d_lat
+            self.correct_lat()
         elif key_code == 127:  # DELETE
             self.search_result = None
+        else:
+            return False
+        return True
+
+    # Обновление параметров карты по нажатой клавише
+    def update(self, key_code):
+        self.step(key_code)
         load_4picture(self)
 
     # Преобразование экранных координат в географические (x,y -> lon,lat)
     def screen_to_geo(self, pos):
-        lon0, lat0 = self.lon, self.lat
-        x, y = pos
-        if x < 540:
-            q = 0 if y < 450 else 1
-        else:
-            q = 2 if y < 450 else 3
-        self.lon = self.lonlat4[q][0]
-        self.lat = self.lonlat4[q][1]
-        dlon, dlat = self.map_size()
-        dx = x - 300 if q in (0, 2) else x - 840
-        dy = 225 - y if q < 2 else 675 - y
-        lon = self.lon + dx * dlon / 600
-        lat = self.lat + dy * dlat / 450
-        self.lon, self.lat = lon0, lat0
-        return lon, lat
+        lon, lat = self.screen_to_geo_arr(pos[0], pos[1])
+        return float(lon), float(lat)
 
     # Преобразование географических координат в экранные  (lon,lat -> x,y)
     def geo_to_screen(self, lon, lat):
-        # важно только это верхняя или нижняя часть
-        lon0, lat0 = self.lon, self.lat  # запомним главный центр
-        dy = 225
-        self.lon = self.lonlat4[0][0]
-        self.lat = self.lonlat4[0][1]
-        dlon, dlat = self.map_size()
-        if lat > self.lat + dlat / 2:
-            dy = 675
-            self.lon = self.lonlat4[2][0]
-            self.lat = self.lonlat4[2][1]
-            dlon, dlat = self.map_size()
-        x = (lon - self.lon) * 600 / dlon + 300
-        y = (self.lat - lat) * 450 / dlat + dy
-        self.lon, self.lat = lon0, lat0  # вернём центр на место
-        return round(x), round(y)
+        x, y = self.geo_to_screen_arr(lon, lat)
+        return int(x), int(y)
+
+    # То же для массивов точек сразу (x, y -> lon, lat)
+    def screen_to_geo_arr(self, x, y):
+        left, top = self.origin()
+        return world_lonlat(np.asarray(x, dtype=np.float64) + left, np.asarray(y, dtype=np.float64) + top, self.zoom)
 
+    # То же для массивов точек сразу (lon, lat -> x, y), целые экранные координаты
+    def geo_to_screen_arr(self, lon, lat):
+        left, top = self.origin()
+        x, y = world_xy(np.asarray(lon, dtype=np.float64), np.asarray(lat, dtype=np.float64), self.zoom)
+        return np.rint(x - left).astype(np.int32), np.rint(y - top).astype(np.int32)
+
+    # адрес точки клика ищется в фоне, ответ придёт событием GEOCODED
     def add_reverse_toponym_search(self, pos):
-        point = self.screen_to_geo(pos)
-        x, y = self.geo_to_screen(point[0], point[1])
-        toponym = reverse_geocode(ll(point[0], point[1]))
-        p = (point[1], point[0])
-        self.search_result = SearchResult(p,
-                                          toponym["metaDataProperty"]["GeocoderMetaData"]["text"] if toponym else None)
+        lon, lat = self.screen_to_geo(pos)
+        self.search_id += 1
+        search_id = self.search_id
+
+        def done(future):
+            try:
+                address = future.result()
+            except Exception as e:
+                print('Адрес не найден:', e)
+                return
+            if address:
+                pygame.event.post(pygame.event.Event(GEOCODED, point=(lat, lon), address=address,
+                                                     search_id=search_id))
+
+        geocoder.reverse(lon, lat).add_done_callback(done)
     # ----------------- end <Map> ---------
 
 
-# Создание карты с параметрами <mp>
-def load_map(mp):
-    ll = mp.lonlat()
-    map_request = f"http://static-maps.yandex.ru/1.x/?ll={ll}&z={mp.zoom}&l={mp.type}"
+# Кэш кусков карты: свежие в памяти, остальные на диске, вытеснение давно не нужных (LRU)
+class TileCache:
+    def __init__(self, path=CACHE_DIR, mem_tiles=CACHE_MEM_TILES, disk_bytes=CACHE_DISK_BYTES):
+        self.path = path
+        self.mem_tiles = mem_tiles
+        self.disk_bytes = disk_bytes
+        self.mem = OrderedDict()  # ключ -> содержимое, последние в конце
+        self.disk = OrderedDict()  # ключ -> размер файла, последние в конце
+        self.disk_size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()  # куски грузятся из нескольких потоков
+        os.makedirs(path, exist_ok=True)
+        # порядок использования файлов восстанавливаем по времени доступа
+        files = []
+        for name in os.listdir(path):
+            fullname = os.path.join(path, name)
+            if name.endswith('.tile') and os.path.isfile(fullname):
+                st = os.stat(fullname)
+                files.append((st.st_mtime, name[:-5], st.st_size))
+        for _, key, size in sorted(files):
+            self.disk[key] = size
+            self.disk_size += size
+        self.shrink()
+
+    @staticmethod
+    def key(*parts):
+        # ключ по содержимому запроса
+        return hashlib.sha1('|'.join(map(str, parts)).encode()).hexdigest()
+
+    def file_name(self, key):
+        return os.path.join(self.path, key + '.tile')
+
+    def get(self, key):
+        with self.lock:
+            return self._get(key)
+
+    def put(self, key, data):
+        with self.lock:
+            self._put(key, data)
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.mem or key in self.disk
+
+    def _get(self, key):
+        if key in self.mem:
+            self.mem.move_to_end(key)
+            self.hits += 1
+            return self.mem[key]
+        if key in self.disk:
+            try:
+                with open(self.file_name(key), 'rb') as f:
+                    data = f.read()
+                os.utime(self.file_name(key))  # отметить использование
+            except OSError:
+                self.disk_size -= self.disk.pop(key)
+            else:
+                self.disk.move_to_end(key)
+                self.hits += 1
+                self.remember(key, data)
+                return data
+        elif os.path.isfile(self.file_name(key)):  # записал другой процесс с тем же каталогом
+            try:
+                with open(self.file_name(key), 'rb') as f:
+                    data = f.read()
+            except OSError:
+                pass
+            else:
+                self.disk[key] = len(data)
+                self.disk_size += len(data)
+                self.hits += 1
+                self.remember(key, data)
+                return data
+        self.misses += 1
+        return None
 
-    if mp.search_result:
-        map_request += "&pt={0},{1},pm2grm".format(mp.search_result.point[0],
-                                                   mp.search_result.point[1])
-    response = requests.get(map_request)
-    if not response:
-        print("Ошибка выполнения запроса:")
-        print(map_request)
-        print("Http статус:", response.status_code, "(", response.reason, ")")
-        sys.exit(1)
-    return response.content
+    def _put(self, key, data):
+        self.remember(key, data)
+        if key in self.disk:
+            self.disk_size -= self.disk.pop(key)
+        tmp = f"{self.file_name(key)}.{os.getpid()}.{threading.get_ident()}"
+        try:
+            with open(tmp, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, self.file_name(key))  # другие процессы не увидят недописанный файл
+        except OSError:
+            return  # без диска работаем только с памятью
+        self.disk[key] = len(data)
+        self.disk_size += len(data)
+        self.shrink()
+
+    def remember(self, key, data):
+        self.mem[key] = data
+        self.mem.move_to_end(key)
+        while len(self.mem) > self.mem_tiles:
+            self.mem.popitem(last=False)
+
+    # удалить самые давние файлы, пока кэш больше предела
+    def shrink(self):
+        while self.disk and self.disk_size > self.disk_bytes:
+            key, size = self.disk.popitem(last=False)
+            self.disk_size -= size
+            try:
+                os.remove(self.file_name(key))
+            except OSError:
+                pass
+
+    def stats(self):
+        total = self.hits + self.misses
+        ratio = self.hits / total * 100 if total else 0
+        return f"попаданий {self.hits}, промахов {self.misses} ({ratio:.0f}%), " \
+               f"в памяти {len(self.mem)}, на диске {len(self.disk)} ({self.disk_size // 1024} КБ)"
+
+
+# Куски карты, готовые к выводу: раскодированы и переведены в формат экрана. Ключ - как в TileCache,
+# вытесняются давние, пока пиксели всех кусков занимают больше <max_bytes>
+class SurfacePool:
+    def __init__(self, max_bytes=SURFACE_POOL_BYTES):
+        self.max_bytes = max_bytes
+        self.items = OrderedDict()  # ключ -> Surface, последние в конце
+        self.size = 0  # байт пикселей во всех кусках
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()  # кладут потоки загрузки, берёт окно
+
+    def get(self, key):
+        with self.lock:
+            surface = self.items.get(key)
+            if surface is None:
+                self.misses += 1
+                return None
+            self.items.move_to_end(key)
+            self.hits += 1
+            return surface
+
+    def put(self, key, surface):
+        with self.lock:
+            old = self.items.pop(key, None)
+            if old is not None:
+                self.size -= old.get_pitch() * old.get_height()
+            self.items[key] = surface
+            self.size += surface.get_pitch() * surface.get_height()
+            while len(self.items) > 1 and self.size > self.max_bytes:
+                _, old = self.items.popitem(last=False)
+                self.size -= old.get_pitch() * old.get_height()
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.items
+
+    def stats(self):
+        total = self.hits + self.misses
+        ratio = self.hits / total * 100 if total else 0
+        return f"попаданий {self.hits}, промахов {self.misses} ({ratio:.0f}%), " \
+               f"кусков {len(self.items)} ({self.size // 1024 // 1024} МБ)"
+
+
+# Источник кусков из Интернета по шаблону адреса {z}/{x}/{y}, с кэшем
+class HttpTiles:
+    local = False
+
+    def __init__(self, url=TILE_URL):
+        self.name = url
+
+    def get(self, z, x, y, quiet=False):
+        url = self.name.format(z=z, x=x, y=y)
+        try:
+            with profiler.span('net'):
+                response = session.get(url, timeout=10)
+        except requests.RequestException as error:
+            if not quiet:
+                print("Ошибка выполнения запроса:", url, error)
+            return None
+        if not response:
+            if quiet:
+                return None
+            print("Ошибка выполнения запроса:")
+            print(url)
+            print("Http статус:", response.status_code, "(", response.reason, ")")
+            return None
+        profiler.count('net_bytes', len(response.content))
+        return response.content
+
+
+# Куски из каталога <path>/{z}/{x}/{y}.png - карта без сети
+class DirTiles:
+    local = True
+
+    def __init__(self, path):
+        self.name = path
+
+    def get(self, z, x, y, quiet=False):
+        fname = os.path.join(self.name, str(z), str(x), f"{y}.png")
+        if not os.path.isfile(fname):
+            return None
+        with open(fname, 'rb') as f:
+            return f.read()
 
 
-# загрузка карты из Интернета
-def load_picture(mp, x, y):
-    img = load_map(mp)
-    im = pygame.image.load(BytesIO(img))
-    screen.blit(im, (x, y))
+# Куски из файла MBTiles (sqlite, строки по схеме TMS - снизу вверх)
+class MBTiles:
+    local = True
 
+    def __init__(self, fname):
+        self.name = fname
+        self.conn = threading.local()  # у каждого потока своё соединение
+
+    def get(self, z, x, y, quiet=False):
+        if not hasattr(self.conn, 'db'):
+            self.conn.db = sqlite3.connect(self.name)
+        row = self.conn.db.execute('SELECT tile_data FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?',
+                                   (z, x, 2 ** z - 1 - y)).fetchone()
+        return row[0] if row else None
+
+
+# источник кусков по строке: файл .mbtiles, каталог или шаблон адреса
+def make_tiles(source):
+    if source.endswith('.mbtiles'):
+        return MBTiles(source)
+    if os.path.isdir(source):
+        return DirTiles(source)
+    return HttpTiles(source)
+
+
+# можно ли с источника <tiles> загружать заранее (соседние виды, куски вдоль маршрутов, картинки маршрутов)
+def bulk_allowed(tiles):
+    if tiles.local:
+        return True
+    host = urlsplit(tiles.name).hostname or ''
+    return not any(host == name or host.endswith('.' + name) for name in NO_BULK_HOSTS)
+
+
+# Кусок карты (z, x, y) из источника <tiles>: байты картинки или None; <quiet> - не сообщать об ошибках
+def load_map(tiles, z, x, y, quiet=False):
+    if tiles.local:
+        return tiles.get(z, x, y)
+    key = TileCache.key(tiles.name, z, x, y)
+    img = tile_cache.get(key)
+    if img is not None:
+        return img
+    img = tiles.get(z, x, y, quiet)
+    if img is not None:
+        tile_cache.put(key, img)
+    return img
+
+
+# Фоновая подгрузка соседних видов (сдвиги во все стороны и масштаб +-1) в кэш; с общих серверов
+# (NO_BULK_HOSTS) не подгружаем
+class Prefetcher:
+    KEYS = (pygame.K_LEFT, pygame.K_RIGHT, pygame.K_UP, pygame.K_DOWN, pygame.K_PAGEUP, pygame.K_PAGEDOWN)
+
+    def __init__(self, workers=2):
+        self.pool = ThreadPoolExecutor(max_workers=workers)  # отдельно от map_pool, чтобы не мешать показу
+        self.generation = 0  # номер текущего вида, задания прежних видов пропускаются
+        self.jobs = []
+
+    # запланировать соседей вида <mp>, прежние задания отменяются
+    def schedule(self, mp):
+        self.generation += 1
+        for job in self.jobs:
+            job.cancel()
+        self.jobs = []
+        if not bulk_allowed(tiles):
+            return
+        for key_code in self.KEYS:
+            nxt = copy.copy(mp)
+            if not nxt.step(key_code):
+                continue
+            for z, x, y, _, _ in nxt.tiles():
+                self.jobs.append(self.pool.submit(self.fetch, self.generation, z, x, y))
+
+    def fetch(self, generation, z, x, y):
+        if generation != self.generation:
+            return  # пользователь уже ушёл с этого вида
+        if TileCache.key(tiles.name, z, x, y) in surface_pool:
+            return
+        load_surface(tiles, z, x, y, quiet=True)  # подгрузка необязательна
+
+
+# картинка из байтов <img> - в Surface формата экрана (если окно уже есть); не картинка - None
+def decode_tile(img):
+    if img is None:
+        return None
+    try:
+        with profiler.span('decode'):
+            surface = pygame.image.load(BytesIO(img))
+            if pygame.display.get_surface() is not None:
+                surface = surface.convert()
+    except pygame.error as error:
+        print("Ошибка чтения куска карты:", error)
+        return None
+    return surface
+
+
+# кусок (z, x, y) для вывода: загрузка (из кэша или сети) и раскодирование - в потоке загрузки, готовый - в пул
+def load_surface(tiles, z, x, y, quiet=False):
+    surface = decode_tile(load_map(tiles, z, x, y, quiet))
+    if surface is not None:
+        surface_pool.put(TileCache.key(tiles.name, z, x, y), surface)
+    return surface
+
+
+# готовый кусок из пула, без раскодирования и обращения к сети; нет - None
+def pooled_tile(tiles, z, x, y):
+    surface = surface_pool.get(TileCache.key(tiles.name, z, x, y))
+    profiler.count('tile_miss' if surface is None else 'tile_hit')
+    return surface
+
+
+# Загрузка и раскодирование недостающих кусков вида в потоках map_pool, готовый кусок приходит событием TILE_LOADED.
+# Куски ушедших видов, до которых не дошла очередь, отменяются; уже начатые загрузки новый вид переиспользует
+class TileLoader:
+    def __init__(self):
+        self.jobs = {}  # (z, x, y) -> Future загрузки
+        self.lock = threading.RLock()  # cancel() вызывает done() сразу, в том же потоке
+
+    # <key> - вид, <wanted> - его недостающие куски (z, x, y, sx, sy)
+    def request(self, key, wanted):
+        need = {(z, x, y) for z, x, y, _, _ in wanted}
+        jobs = []
+        with self.lock:
+            for zxy, job in list(self.jobs.items()):
+                if zxy not in need and job.cancel():
+                    self.jobs.pop(zxy, None)
+            for z, x, y, sx, sy in wanted:
+                job = self.jobs.get((z, x, y))
+                if job is None:
+                    job = self.jobs[(z, x, y)] = map_pool.submit(load_surface, tiles, z, x, y)
+                jobs.append((job, (z, x, y), (sx, sy)))
+        # готовая загрузка вызывает done() сразу, поэтому - вне блокировки
+        for job, zxy, pos in jobs:
+            job.add_done_callback(lambda job, zxy=zxy, pos=pos: self.done(key, zxy, pos, job))
+
+    def done(self, key, zxy, pos, job):
+        with self.lock:
+            if self.jobs.get(zxy) is job:
+                del self.jobs[zxy]
+        if not job.cancelled():
+            pygame.event.post(pygame.event.Event(TILE_LOADED, key=key, pos=pos, img=job.result()))
+
+
+# вывод раскодированного куска карты <img> на экран; нет куска - серый квадрат
+def load_picture(img, x, y, surface=None):
+    if surface is None:
+        surface = layers.base
+    if img is None:
+        pygame.draw.rect(surface, (200, 200, 200), ((x, y), (TILE, TILE)))
+        return
+    surface.blit(img, (x, y))
+
+
+# Слои экрана: карта и маршруты кэшируются и пересобираются, только когда меняется вид или маршруты
+class Layers:
+    def __init__(self):
+        self.base = pygame.Surface((VIEW_W, VIEW_H))  # карта из кусков
+        self.overlay = pygame.Surface((VIEW_W, VIEW_H), pygame.SRCALPHA)  # маршруты
+        self.scene = pygame.Surface((1200, 900))  # весь экран без спрайтов
+        self.base_key = None
+        self.overlay_key = None
+
+    # заново собрать фон в месте <rect> карты из слоя карты и слоя маршрутов
+    def compose(self, rect):
+        rect = pygame.Rect(rect).clip((0, 0, VIEW_W, VIEW_H))
+        self.scene.blit(self.base, rect, rect)
+        self.scene.blit(self.overlay, rect, rect)
+        return rect
+
+    # перерисовать спрайты в местах <rects> поверх готового фона и обновить на экране только их
+    def refresh(self, *rects):
+        for rect in rects:
+            screen.blit(self.scene, rect, rect)
+        all_sprites.draw(screen)
+        pygame.display.update(rects)
+
+
+# пришедший кусок - в слой карты и на экран, только его место
+def show_tile(img, sx, sy):
+    load_picture(img, sx, sy)
+    layers.refresh(layers.compose((sx, sy, TILE, TILE)))
 
-# загрузка и соединение 4-х частей карты
+
+# сборка карты на экране: готовые куски из пула - сразу, остальное - серым, пока не загрузится и не раскодируется
 def load_4picture(mp):
-    lat_top_corr = [0.4, 0.1, 0.025, 0.005, 0.0018, 0.0005]
-    lat, lon = mp.lat, mp.lon  # запомнить главный центр
-    dlon, dlat = mp.map_size()
-    mp.lat = lat + dlat / 2  # верхняя половина карты
-    if mp.zoom in range(5, 11):
-        mp.lat -= lat_top_corr[mp.zoom - 5]  # иногда немного приподнять вверх
-    mp.lon = lon - dlon * 0.4  # чтобы по ширине было 90% - убрать "Яндекс"
-    dlon *= 0.9
-    mp.correct_lon()
-    load_picture(mp, 0, 0)
-    mp.lonlat4[0] = mp.lon, mp.lat
-    mp.lon += dlon
-    mp.correct_lon()
-    load_picture(mp, 540, 0)
-    mp.lonlat4[1] = mp.lon, mp.lat
-    mp.lat -= dlat
-    mp.lon -= dlon
-    mp.correct_lon()
-    load_picture(mp, 0, 450)
-    mp.lonlat4[2] = mp.lon, mp.lat
-    mp.lon += dlon
-    mp.correct_lon()
-    load_picture(mp, 540, 450)
-    mp.lonlat4[3] = mp.lon, mp.lat
-    mp.lat, mp.lon = lat, lon  # вернуть главный центр
+    start = profiler.begin_frame()
+    view = (mp.origin(), mp.zoom)
+    key = (view, tiles.name)
+    if key != layers.base_key:
+        layers.base.fill((200, 200, 200))  # за краем мира (у полюсов) кусков нет - там серое
+        missing = []
+        for z, x, y, sx, sy in mp.tiles():
+            with profiler.span('pool'):
+                img = pooled_tile(tiles, z, x, y)
+            if img is None:
+                missing.append((z, x, y, sx, sy))
+            load_picture(img, sx, sy)
+        tile_loader.request(key, missing)
+        layers.base_key = key
+    key = (view, routes.version)
+    if key != layers.overlay_key:
+        layers.overlay.fill((0, 0, 0, 0))
+        with profiler.span('route'):
+            for route in routes:
+                draw_route(mp, route, layers.overlay)  # маршруты есть - рисуем их
+                route.place_sprites(mp)
+        layers.overlay_key = key
+    with profiler.span('blit'):
+        screen.blit(layers.base, (0, 0))
+        screen.blit(layers.overlay, (0, 0))
     if mp.search_result:
-        # Если указали мышкой на точку, то печатаем адрес
-        font = pygame.font.Font(None, 30)
-        text = font.render(mp.search_result.address, 1, (0, 128, 0))
-        screen.blit(text, (20, 860))
+        # Если указали мышкой на точку, то отмечаем её и печатаем адрес
+        x, y = mp.geo_to_screen(mp.search_result.point[1], mp.search_result.point[0])
+        pygame.draw.circle(screen, (255, 255, 255), (x, y), 7)
+        pygame.draw.circle(screen, (0, 128, 0), (x, y), 5)
+        screen.blit(render_text(mp.search_result.address, 30, (0, 128, 0), None), (20, 860))
     mp.search_result = None  # потом надпись удалится
-    if route:
-        # маршрут есть - рисуем его
-        x0, y0 = mp.geo_to_screen(route.lon[0], route.lat[0])
-        route.sprite_start.rect.x = x0 - 12
-        route.sprite_start.rect.y = y0 - 12
-        for i in range(1, len(route.lon)):
-            x1, y1 = mp.geo_to_screen(route.lon[i], route.lat[i])
-            good0 = (0 <= x0 <= 1080) and (0 <= y0 <= 900)
-            good1 = (0 <= x1 <= 1080) and (0 <= y1 <= 900)
-            if good0 or good1:
-                route.pos[i] = (x1, y1)
-                route.pos[i - 1] = (x0, y0)
-                pygame.draw.line(screen, (0, 160, 96), (x0, y0), (x1, y1), 5)
-                if i % 5 == 0:
-                    pygame.draw.circle(screen, (255, 0, 0), (x0, y0), 2)
-                    pygame.draw.circle(screen, (255, 255, 0), (x0, y0), 3, 1)
-            else:
-                route.pos[i] = (None, None)
-                route.pos[i - 1] = (None, None)
-            x0, y0 = x1, y1
-        route.sprite_finish.rect.x = x1 - 12
-        route.sprite_finish.rect.y = y1 - 12
-
-    pygame.draw.line(screen, (0, 0, 160), (0, 449), (1199, 449), 1)
-    pygame.draw.line(screen, (0, 0, 160), (540, 0), (540, 899), 1)
+
     pygame.draw.rect(screen, (224, 200, 80), ((1080, 0), (120, 900)))
     pygame.draw.rect(screen, (80, 104, 128), ((1083, 3), (114, 894)))
-    print_txt(mp)  # печать всей текстовой информации на правом боку
+    with profiler.span('text'):
+        print_txt(mp)  # печать всей текстовой информации на правом боку
+    profiler.end_frame(start)
+    if profiler.enabled:
+        print_profile()
+    layers.scene.blit(screen, (0, 0))
     all_sprites.draw(screen)
-    pygame.display.flip()
+    with profiler.span('flip'):
+        pygame.display.flip()
+    prefetcher.schedule(mp)
+
+
+# Рисование маршрута на <surface>: упрощённый для масштаба, только видимые куски
+def draw_route(mp, route, surface):
+    if route.empty:
+        return
+    level = min(max(mp.zoom, 5), 19)
+    lod = route.lod[level]
+    starts, ends, lon_min, lon_max, lat_min, lat_max = route.chunks[level]
+    # видимая область с запасом - куски вне её даже не пересчитываем в экранные
+    lon_v, lat_v = mp.screen_to_geo_arr((-10, 1090, -10, 1090), (-10, -10, 910, 910))
+    seen = np.flatnonzero((lon_max >= lon_v.min()) & (lon_min <= lon_v.max()) &
+                          (lat_max >= lat_v.min()) & (lat_min <= lat_v.max()))
+    # только выбранный участок start..finish: точки упрощения внутри него, а края - точно, всеми точками
+    first, last = np.searchsorted(lod, (route.start, route.finish + 1))
+    if first < last:
+        for a, b in ((route.start, lod[first]), (lod[last - 1], route.finish)):
+            if b > a:
+                xs, ys = mp.geo_to_screen_arr(route.lon[a:b + 1], route.lat[a:b + 1])
+                pygame.draw.lines(surface, route.color, False, np.column_stack((xs, ys)).tolist(), 5)
+    elif route.finish > route.start:
+        xs, ys = mp.geo_to_screen_arr(route.lon[route.start:route.finish + 1], route.lat[route.start:route.finish + 1])
+        pygame.draw.lines(surface, route.color, False, np.column_stack((xs, ys)).tolist(), 5)
+    if len(seen):
+        pos = np.unique(np.concatenate([np.arange(starts[k], ends[k] + 1) for k in seen.tolist()]))
+        pos = pos[(first <= pos) & (pos < last)]
+    if len(seen) and len(pos):
+        xs, ys = mp.geo_to_screen_arr(route.lon[lod[pos]], route.lat[lod[pos]])
+        good = (0 <= xs) & (xs <= 1080) & (0 <= ys) & (ys <= 900)
+        xy = np.column_stack((xs, ys)).tolist()
+        # рисуем только отрезки, у которых виден хотя бы один конец; подряд идущие - одной ломаной
+        draw = (good[:-1] | good[1:]) & (np.diff(pos) == 1)
+        edges = np.flatnonzero(np.diff(np.concatenate(([False], draw, [False]))))
+        for a, b in edges.reshape(-1, 2).tolist():
+            pygame.draw.lines(surface, route.color, False, xy[a:b + 1], 5)
+        marks = np.flatnonzero(draw & (pos[1:] % 5 == 0))  # каждая 5-я точка
+        for i in marks.tolist():
+            pygame.draw.circle(surface, (255, 0, 0), xy[i], 2)
+            pygame.draw.circle(surface, (255, 255, 0), xy[i], 3, 1)
 
 
 def load_sprite(x, y, fname, alpha=False):
@@ -255,29 +944,62 @@ def load_sprite(x, y, fname, alpha=False):
     return sprite
 
 
+# шрифт <fname> размера <size>, каждый загружается один раз
+def get_font(size, fname=FONT_FILE):
+    font = fonts.get((fname, size))
+    if font is None:
+        font = fonts[(fname, size)] = pygame.font.Font(fname, size)
+    return font
+
+
+# надпись рисуется один раз, потом берётся готовая
+def render_text(text, size, color, fname=FONT_FILE):
+    key = (text, size, color, fname)
+    surface = texts.get(key)
+    if surface is None:
+        surface = texts[key] = get_font(size, fname).render(text, 1, color)
+        while len(texts) > TEXT_CACHE:
+            texts.popitem(last=False)
+    else:
+        texts.move_to_end(key)
+    return surface
+
+
 # печать строки на экран
 def write_text(text, size, color, x, y):
-    font = pygame.font.Font('fonts/arial.ttf', size)
-    text = font.render(text, 1, color)
-    screen.blit(text, (x, y))
+    screen.blit(render_text(text, size, color), (x, y))
+
+
+# Подсказка к точке маршрута: шаблон и шрифт загружаются один раз, картинка собирается в памяти
+class InfoCloud:
+    def __init__(self, fname='info_cloud.png'):
+        self.template = Image.open(os.path.join('Images', fname)).convert('RGBA')
+        self.font = ImageFont.truetype(FONT_FILE, size=9)
+
+    # спрайт с датой, временем, скоростью и пробегом <record> в точке (x, y)
+    def sprite(self, record, x, y):
+        date_point, time_point, spd_point, metr_point = record
+        img = self.template.copy()
+        draw_img = ImageDraw.Draw(img)
+        draw_img.text((64, 21), time_point[:5], font=self.font, fill=(0, 0, 0))
+        draw_img.text((53, 57), date_point[2:], font=self.font, fill=(0, 0, 0))
+        draw_img.text((167, 21), spd_point, font=self.font, fill=(0, 0, 0))
+        draw_img.text((162, 58), str(metr_point), font=self.font, fill=(0, 0, 0))
+        image = pygame.image.frombuffer(img.tobytes(), img.size, 'RGBA').convert()
+        image.set_colorkey(image.get_at((0, 0)))  # как у load_sprite(..., alpha=True)
+        sprite = pygame.sprite.Sprite()
+        sprite.image = image
+        sprite.rect = image.get_rect(topleft=(x, y))
+        return sprite
 
 
 #  поиск координат по адресу
 def adres_coord(adres):
-    # global toponym_longitude, toponym_lattitude
-    geocoder_api_server = "http://geocode-maps.yandex.ru/1.x/"
-    geocoder_params = {
-        "apikey": "40d1649f-0493-4b70-98ba-98533de7710b",
-        "geocode": adres,
-        "format": "json"}
-    response = requests.get(geocoder_api_server, params=geocoder_params)
-    if not response:
+    try:
+        return geocoder.geocode(adres).result()
+    except Exception as e:
+        print('Адрес не найден:', e)
         return None
-    json_response = response.json()
-    toponym = json_response["response"]["GeoObjectCollection"]["featureMember"][0]["GeoObject"]
-    toponym_coordinates = toponym["Point"]["pos"]
-    lon, lat = toponym_coordinates.split()
-    return float(lon), float(lat)
 
 
 class Button:
@@ -289,21 +1011,20 @@ class Button:
         self.sprites[0] = load_sprite(x, y, name0)
         self.sprites[1] = load_sprite(-100, -100, name1)
         all_sprites.add(self.sprites[0])
-        all_sprites.draw(screen)
-        pygame.display.flip()  # ...показать на форме
+        layers.refresh(self.sprites[0].rect)  # ...показать на форме
 
     def set_active(self, active):
         if self.active == active:
             return
         i0, i1 = (0, 1) if active else (1, 0)
+        old = self.sprites[i0].rect.copy()
         # меняем состояние
         self.sprites[i1].rect.x = self.x
         self.sprites[i1].rect.y = self.y
         all_sprites.remove(self.sprites[i0])
         self.sprites[i0].rect.x, self.sprites[i0].rect.y = -100, -100  # убираем совсем
         all_sprites.add(self.sprites[i1])
-        all_sprites.draw(screen)
-        pygame.display.flip()
+        layers.refresh(old, self.sprites[i1].rect)
         self.active = active
 
     def sprite(self):
@@ -314,145 +1035,918 @@ class Button:
 class Open_Dialog(QMainWindow):
     def __init__(self):
         super().__init__()
-        self.filename = QFileDialog.getOpenFileName(
-            self, 'Выбрать csv или xml файл', os.getcwd() + '/data', 'гео-файл (*.csv *xml *gpx);;Все файлы (*)')[0]
+        self.filenames = QFileDialog.getOpenFileNames(
+            self, 'Выбрать csv или xml файлы', os.getcwd() + '/data', 'гео-файл (*.csv *xml *gpx *kml);;Все файлы (*)')[0]
 
 
 def select_File():
     app = QApplication(sys.argv)
     Open_Dialog1 = Open_Dialog()
-    return Open_Dialog1.filename
-
-
-def distance(lat_1, lon_1, lat_2, lon_2):
-    r = 6371
-    lat = (lat_2 - lat_1) * pi / 180
-    lon = (lon_2 - lon_1) * pi / 180
-    a = sin(lat / 2) * sin(lat / 2) + cos(lat_1 * pi / 180) * cos(lat_2 * pi / 180) * sin(lon / 2) * sin(lon / 2)
-    c = 2 * atan2(sqrt(a), sqrt(1 - a))
-    d = r * c
-    return d
-
+    return Open_Dialog1.filenames
+
+
+# Потоковое чтение точек трека из GPX (все trk/trkseg и rte) или KML (gx:Track): (время, широта, долгота, высота);
+# времени или высоты может не быть (например, в запланированном маршруте) - тогда ''
+def read_track_xml(fname):
+    in_track = False
+    whens, coords = deque(), deque()  # в KML время и координаты идут отдельными тегами
+    for event, elem in ET.iterparse(fname, events=('start', 'end')):
+        tag = elem.tag.rsplit('}', 1)[-1]  # без пространства имён
+        if event == 'start':
+            if tag == 'Track':
+                in_track = True
+                whens.clear()
+                coords.clear()
+            continue
+        if tag in ('trkpt', 'rtept'):
+            when, ele = '', ''
+            for child in elem:
+                name = child.tag.rsplit('}', 1)[-1]
+                if name == 'time':
+                    when = child.text
+                elif name == 'ele':
+                    ele = child.text
+            yield when or '', elem.get('lat'), elem.get('lon'), ele or ''  # без времени - NaT
+            elem.clear()
+        elif in_track and tag == 'when':
+            whens.append(elem.text)
+            elem.clear()
+        elif in_track and tag == 'coord':
+            coords.append(elem.text)
+            elem.clear()
+        elif tag in ('trkseg', 'Track'):
+            in_track = False
+            elem.clear()
+        while whens and coords:
+            lon, lat, *ele = coords.popleft().split()
+            yield whens.popleft(), lat, lon, ele[0] if ele else ''
+
+
+# перевод столбца строк в числа разом; плохие строки - в маску
+def to_array(strings, dtype):
+    try:
+        return strings.astype(dtype), np.zeros(len(strings), bool)
+    except ValueError:
+        pass
+    values = np.zeros(len(strings), dtype)
+    bad = np.zeros(len(strings), bool)
+    for i, s in enumerate(strings):  # медленный путь - только если есть ошибки
+        try:
+            values[i] = dtype(s)
+        except ValueError:
+            bad[i] = True
+    return values, bad
+
+
+# время 'ГГГГ.ММ.ДД чч:мм:сс' (или с '-' и 'T') -> datetime64 разбором байтов по позициям, непонятное -> NaT
+def to_datetime(strings):
+    strings = np.asarray(strings)
+    try:
+        b = strings.astype('S19')
+    except UnicodeEncodeError:  # не латиница (например, «вчера») - такие строки станут NaT
+        b = np.array([str(text).encode('ascii', 'replace')[:19] for text in strings], 'S19')
+    if not len(b):
+        return np.empty(0, 'datetime64[s]')
+    c = np.ascontiguousarray(b).view(np.uint8).reshape(-1, 19) - np.uint8(ord('0'))
+    high, low = c[:, [0, 2, 5, 8, 11, 14, 17]], c[:, [1, 3, 6, 9, 12, 15, 18]]  # пары цифр: ГГ ГГ ММ ДД чч мм сс
+    ok = (high <= 9).all(axis=1) & (low <= 9).all(axis=1) & (c[:, 13] == ord(':') - ord('0')) & \
+        (c[:, 16] == ord(':') - ord('0'))
+    pairs = high.astype(np.int32) * 10 + low
+    pairs[~ok] = 0  # чтобы арифметика ниже не переполнялась
+    months = (pairs[:, 0] * 100 + pairs[:, 1] - 1970) * 12 + pairs[:, 2] - 1
+    days = months.astype('datetime64[M]').astype('datetime64[D]') + (pairs[:, 3] - 1)
+    values = days.astype('datetime64[s]') + (pairs[:, 4] * 3600 + pairs[:, 5] * 60 + pairs[:, 6])
+    values[~ok] = np.datetime64('NaT')
+    return values
+
+
+# Ось времени для двоичного поиска: секунды эпохи, неубывающие - NaT и скачки назад
+# заменяются предыдущим значением (NaT в начале - первым известным временем, чтобы проигрывание с них
+# начиналось не с «минус бесконечности»)
+def time_axis(time):
+    known = ~np.isnat(time)
+    first = time[known][0].astype(np.int64) if known.any() else 0
+    sec = np.where(known, time.astype(np.int64), first)
+    return np.maximum.accumulate(sec) if len(sec) else sec
+
+
+# Кусок CSV из строк одной длины (логгер дополняет поля пробелами до постоянной ширины) - матрица байтов
+# (строк, ширина): если ';' и десятичные точки во всех строках на тех же местах, у каждого столбца свой разряд,
+# и числа всех четырёх полей - одно матричное умножение. Числа до 15 цифр: целая мантисса в float64 точна,
+# одно деление на степень 10 даёт то же, что float(). None - раскладка не такая, разбирать loadtxt
+def parse_csv_block(lines):
+    eol = 2 if lines.shape[1] > 1 and lines[0, -2] == ord('\r') else 1
+    if lines.shape[1] - eol < 28 or (eol == 2 and (lines[:, -2] != ord('\r')).any()):
+        return None
+    template = lines[0, 19:-eol].tobytes().replace(b',', b'.').split(b';')
+    if len(template) != 5 or template[0]:
+        return None
+    text = np.ascontiguousarray(lines[:, 19:-eol]).ravel()  # с ';' после даты: строки не сливаются
+    width = len(text) // len(lines)
+    value = text - np.uint8(ord('0'))
+    digit = value <= 9
+    dot = (text == ord('.')) | (text == ord(','))
+    minus = text == ord('-')
+    space = text == ord(' ')
+    sep = text == ord(';')
+    body = digit | dot | minus
+    # ';' и точки - там же, где в первой строке; пробелы только перед числом, минус - только первым знаком
+    if (sep[width:] != sep[:-width]).any() or (dot[width:] != dot[:-width]).any() or \
+            not (body | space | sep).all() or (body[:-1] & space[1:]).any() or (minus[1:] & body[:-1]).any():
+        return None
+    digit = digit.reshape(-1, width)
+    weight = np.zeros((width, 4))
+    scale = np.ones(4)
+    fields = []
+    start = 1
+    for k, field in enumerate(template[1:]):
+        stop = start + len(field)
+        point = field.find(b'.')
+        cols = [start + i for i in range(len(field)) if i != point]
+        if not field or field.count(b'.') > 1 or len(cols) > 15 or not digit[:, stop - 1].all():
+            return None
+        weight[cols, k] = 10.0 ** np.arange(len(cols) - 1, -1, -1)
+        scale[k] = 10.0 ** (len(field) - 1 - point) if point >= 0 else 1
+        fields.append((start, stop))
+        start = stop + 1
+    num = (value.reshape(-1, width) * digit).astype(np.float64) @ weight / scale
+    if minus.any():
+        minus = minus.reshape(-1, width)
+        for k, (start, stop) in enumerate(fields):
+            num[:, k] = np.where(minus[:, start:stop].any(axis=1), -num[:, k], num[:, k])
+    return lines[:, :19].copy().view('S19').ravel(), num
+
+
+# Быстрый разбор CSV без токенизатора: текст режется на куски из подряд идущих строк одинаковой длины
+# (у логгера это почти весь файл), каждый - parse_csv_block. None - кусков слишком много или какой-то не
+# разобрался
+def read_csv_fast(data):
+    buf = np.frombuffer(data.rstrip() + b'\n', np.uint8)
+    ends = np.flatnonzero(buf == ord('\n')) + 1
+    starts = np.append(0, ends[:-1])
+    cut = np.flatnonzero(np.diff(ends - starts)) + 1
+    if len(cut) > len(ends) // 100 + 10:
+        return None
+    parts = []
+    for a, b in zip(np.append(0, cut), np.append(cut, len(ends))):
+        part = parse_csv_block(buf[starts[a]:ends[b - 1]].reshape(b - a, -1))
+        if part is None:
+            return None
+        parts.append(part)
+    return np.concatenate([dat for dat, num in parts]), np.concatenate([num for dat, num in parts])
+
+
+# Разбор текста CSV (DAT;LAT;LON;SPD;Metr, без заголовка): даты, числа (n, 4) и номера плохих строк.
+# Сначала read_csv_fast, иначе один проход loadtxt; построчно проверяем только если и он споткнулся
+def read_csv_columns(data, first_line=2):
+    dtype = [('dat', 'S19'), ('lat', 'f8'), ('lon', 'f8'), ('spd', 'f8'), ('metr', 'f8')]
+    bad = []
+    if not data.strip():
+        return np.empty(0, 'S19'), np.empty((0, 4)), bad
+    fast = read_csv_fast(data)
+    if fast is not None:
+        return fast[0], fast[1], bad
+    try:
+        table = np.loadtxt(BytesIO(data.replace(b',', b'.')), delimiter=';', usecols=range(5), dtype=dtype,
+                           ndmin=1, comments=None)
+    except ValueError:
+        good = []
+        for k, line in enumerate(data.replace(b',', b'.').splitlines(), first_line):
+            if not line.strip():
+                continue
+            row = line.split(b';')
+            try:
+                if len(row) < 5:
+                    raise ValueError
+                for field in row[1:5]:
+                    float(field)
+            except ValueError:
+                bad.append(k)
+            else:
+                good.append(b';'.join(row[:5]))
+        if not good:
+            return np.empty(0, 'S19'), np.empty((0, 4)), bad
+        table = np.loadtxt(good, delimiter=';', dtype=dtype, ndmin=1, comments=None)
+    num = np.column_stack([table[name] for name in ('lat', 'lon', 'spd', 'metr')])
+    return table['dat'], num, bad
+
+
+# длины отрезков между соседними точками, км (по формуле гаверсинусов)
+def distances(lat, lon):
+    lat1, lat2 = np.radians(lat[:-1]), np.radians(lat[1:])
+    dlon = np.radians(lon[1:] - lon[:-1])
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlon / 2) ** 2
+    return 6371 * 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+
+
+# Значимость точек по Дугласу-Пекеру: до какого допуска (в пикселях при z=15) точка ещё нужна.
+# Один проход даёт упрощение сразу для всех масштабов; отрезки мельче <min_tol> дальше не делим
+def dp_significance(x, y, min_tol):
+    n = len(x)
+    sig = np.zeros(n)
+    sig[0] = sig[-1] = np.inf
+    stack = [(0, n - 1, np.inf)]
+    while stack:
+        a, b, limit = stack.pop()
+        if b - a < 2:
+            continue
+        px, py = x[a + 1:b] - x[a], y[a + 1:b] - y[a]
+        dx, dy = x[b] - x[a], y[b] - y[a]
+        norm = np.hypot(dx, dy)
+        d = np.abs(dy * px - dx * py) / norm if norm else np.hypot(px, py)
+        j = int(np.argmax(d))
+        dmax = min(d[j], limit)  # точка не может быть важнее родительской
+        if dmax < min_tol:
+            continue
+        k = a + 1 + j
+        sig[k] = dmax
+        stack.append((a, k, dmax))
+        stack.append((k, b, dmax))
+    return sig
+
+
+# Упрощённые маршруты для масштабов 5..19: zoom -> индексы точек, различимых на экране
+def simplify_levels(lon, lat):
+    if len(lon) < 3:
+        return {z: np.arange(len(lon)) for z in ROUTE_LEVELS}
+    x, y = world_xy(lon, lat, 15)
+    sig = dp_significance(x, y, 2 ** (15 - 19))
+    return {z: np.flatnonzero(sig >= 2 ** (15 - z)) for z in ROUTE_LEVELS}
+
+
+# Куски маршрута по CHUNK точек: начало, конец (включительно - это начало следующего) и границы каждого
+def chunk_boxes(lon, lat, chunk=CHUNK):
+    n = len(lon)
+    starts = np.arange(0, max(n - 1, 1), chunk)
+    ends = np.minimum(starts + chunk, n - 1)
+    lon_min = np.minimum(np.minimum.reduceat(lon, starts), lon[ends])
+    lon_max = np.maximum(np.maximum.reduceat(lon, starts), lon[ends])
+    lat_min = np.minimum(np.minimum.reduceat(lat, starts), lat[ends])
+    lat_max = np.maximum(np.maximum.reduceat(lat, starts), lat[ends])
+    return starts, ends, lon_min, lon_max, lat_min, lat_max
+
+
+# Индекс точек трека: отсортированы по долготе, поиск - двоичный по полосе долгот + проверка массивом
+class TrackIndex:
+    def __init__(self, lon, lat, order=None):
+        self.order = np.argsort(lon, kind='stable') if order is None else order
+        self.lon = lon[self.order]
+        self.lat = lat[self.order]
+
+    # ближайшая точка в эллипсе с полуосями <rlon>, <rlat> градусов (один пиксель по x и y разный);
+    # только из точек с индексами <start>..<finish>, если он задан
+    def query(self, lon, lat, rlon, rlat, start=0, finish=None):
+        lo, hi = np.searchsorted(self.lon, (lon - rlon, lon + rlon))
+        if lo == hi:
+            return None
+        d = ((self.lon[lo:hi] - lon) / rlon) ** 2 + ((self.lat[lo:hi] - lat) / rlat) ** 2
+        if finish is not None:
+            idx = self.order[lo:hi]
+            d[(idx < start) | (idx > finish)] = np.inf
+        j = int(np.argmin(d))
+        if d[j] > 1:
+            return None
+        return int(self.order[lo + j])
+
+
+# Статистика трека: по отрезкам считается разом, для любого участка i..j итоги берутся из накопленных сумм
+# за O(1), наибольшая скорость - из разреженной таблицы максимумов (тоже O(1))
+class TrackStats:
+    def __init__(self, track):
+        d = distances(track.lat, track.lon) * 1000  # м
+        sec = np.diff(track.time).astype(np.float64)
+        sec[~np.isfinite(sec) | (sec < 0)] = 0  # нет времени - отрезок не считаем по времени
+        spd = np.zeros(len(d))
+        np.divide(d * 3.6, sec, out=spd, where=sec > 0)
+        moving = spd >= STOP_SPEED
+        climb = np.nan_to_num(np.diff(track.ele))
+        self.has_ele = bool(np.isfinite(track.ele).any())
+        self.speed = spd  # км/ч на каждом отрезке
+        self.dist = np.concatenate(([0.0], np.cumsum(d)))  # м от начала до точки
+        # для средних скоростей - только отрезки с известной длительностью, иначе средняя выйдет больше наибольшей
+        self.timed = np.concatenate(([0.0], np.cumsum(np.where(sec > 0, d, 0))))  # м
+        self.moved = np.concatenate(([0.0], np.cumsum(np.where(moving, d, 0))))  # м в движении
+        self.time = np.concatenate(([0.0], np.cumsum(sec)))  # с от начала
+        self.moving = np.concatenate(([0.0], np.cumsum(np.where(moving, sec, 0))))  # с в движении
+        self.gain = np.concatenate(([0.0], np.cumsum(np.maximum(climb, 0))))  # м набора высоты
+        self.loss = np.concatenate(([0.0], np.cumsum(np.maximum(-climb, 0))))  # м спуска
+        self.max_table = [spd]  # max_table[k][i] - наибольшая скорость на отрезках i..i+2**k-1
+        while 2 ** len(self.max_table) <= len(spd):
+            prev, k = self.max_table[-1], 2 ** (len(self.max_table) - 1)
+            self.max_table.append(np.maximum(prev[:-k], prev[k:]))
+
+    # наибольшая скорость на участке от точки i до точки j
+    def max_speed(self, i, j):
+        i, j = int(i), int(j)
+        if j <= i:
+            return 0.0
+        k = (j - i).bit_length() - 1
+        return float(max(self.max_table[k][i], self.max_table[k][j - 2 ** k]))
+
+    # итоги участка от точки i до точки j включительно
+    def summary(self, i, j):
+        elapsed = self.time[j] - self.time[i]
+        moving = self.moving[j] - self.moving[i]
+        dist = self.dist[j] - self.dist[i]
+        return {'dist': dist, 'time': elapsed, 'moving': moving, 'stopped': elapsed - moving,
+                'avg_speed': (self.timed[j] - self.timed[i]) * 3.6 / elapsed if elapsed else 0.0,
+                'moving_speed': (self.moved[j] - self.moved[i]) * 3.6 / moving if moving else 0.0,
+                'max_speed': self.max_speed(i, j),
+                'gain': self.gain[j] - self.gain[i] if self.has_ele else None,
+                'loss': self.loss[j] - self.loss[i] if self.has_ele else None}
+
+    # отрезки по <step> м на участке i..j: индексы точек начала каждого, длительность, с, и средняя скорость, км/ч
+    def splits(self, i=0, j=None, step=1000):
+        j = len(self.dist) - 1 if j is None else j
+        marks = np.arange(self.dist[i], self.dist[j], step)[1:]
+        bounds = np.concatenate(([i], np.searchsorted(self.dist, marks), [j]))
+        seconds = np.diff(self.time[bounds])
+        meters = np.diff(self.timed[bounds])
+        speed = np.zeros(len(seconds))
+        np.divide(meters * 3.6, seconds, out=speed, where=seconds > 0)
+        return bounds[:-1], seconds, speed
+
+
+# итоги участка одной строкой - для печати
+def summary_text(summary):
+    text = (f"{summary['dist'] / 1000:.2f} км за {summary['time'] / 3600:.2f} ч "
+            f"(в движении {summary['moving'] / 3600:.2f} ч), средняя {summary['avg_speed']:.1f} км/ч, "
+            f"в движении {summary['moving_speed']:.1f} км/ч, наибольшая {summary['max_speed']:.1f} км/ч")
+    if summary['gain'] is not None:
+        text += f", подъём {summary['gain']:.0f} м, спуск {summary['loss']:.0f} м"
+    return text
+
+
+# Двоичная копия маршрута в ROUTE_CACHE_DIR: заголовок, затем столбцы подряд -
+# lon, lat (float64), time (int64, секунды), ele (float64, NaN - нет высоты), dist (int32), spd (float32),
+# порядок индекса по долготе (int32),
+# число точек каждого упрощения (int32 x 15) и сами индексы упрощений (int32).
+# Заголовок: метка, число точек, mtime_ns и размер исходного файла, его sha1, длина упрощений, границы
+ROUTE_HEADER = struct.Struct('<4sIqq20sI4d')
+ROUTE_MAGIC = b'MRT2'
+
+
+def route_cache_name(fname):
+    return os.path.join(ROUTE_CACHE_DIR, hashlib.sha1(os.path.abspath(fname).encode()).hexdigest() + '.route')
+
+
+def file_sha1(fname):
+    with open(fname, 'rb') as f:
+        return hashlib.sha1(f.read()).digest()
+
+
+def save_route_cache(track):
+    st = os.stat(track.fname)
+    levels = [track.lod[z] for z in ROUTE_LEVELS]
+    header = ROUTE_HEADER.pack(ROUTE_MAGIC, len(track.lon), st.st_mtime_ns, st.st_size, file_sha1(track.fname),
+                               sum(map(len, levels)), *track.bbox)
+    columns = [track.lon.astype('<f8'), track.lat.astype('<f8'), track.time.astype('<i8'), track.ele.astype('<f8'),
+               track.dist.astype('<i4'), track.spd.astype('<f4'), track.index.order.astype('<i4'),
+               np.array([len(lod) for lod in levels], '<i4')] + [lod.astype('<i4') for lod in levels]
+    name = route_cache_name(track.fname)
+    try:
+        os.makedirs(ROUTE_CACHE_DIR, exist_ok=True)
+        with open(name + '.tmp', 'wb') as f:
+            f.write(header)
+            for col in columns:
+                f.write(col.tobytes())
+        os.replace(name + '.tmp', name)  # чтобы не оставить недописанный файл
+    except OSError as e:
+        print('Не удалось сохранить копию маршрута', name, e)
+
+
+# Массивы маршрута прямо из отображённой в память копии (без чтения и копирования) или None,
+# если копии нет или исходный файл менялся: сначала сверяем mtime и размер, при расхождении - sha1
+def load_route_cache(fname):
+    name = route_cache_name(fname)
+    try:
+        st = os.stat(fname)
+        with open(name, 'rb') as f:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+    if len(buf) < ROUTE_HEADER.size:
+        return None
+    magic, n, mtime_ns, size, sha1, lod_total, *bbox = ROUTE_HEADER.unpack_from(buf)
+    if magic != ROUTE_MAGIC or size != st.st_size or len(buf) != ROUTE_HEADER.size + 44 * n + 4 * (15 + lod_total):
+        return None
+    if mtime_ns != st.st_mtime_ns:
+        if sha1 != file_sha1(fname):
+            return None
+        try:  # файл только «потрогали» - запомним новое время, чтобы не считать sha1 каждый раз
+            with open(name, 'r+b') as f:
+                f.seek(8)
+                f.write(struct.pack('<q', st.st_mtime_ns))
+        except OSError:
+            pass
+    columns = {}
+    offset = ROUTE_HEADER.size
+    for key, dtype, count in (('lon', '<f8', n), ('lat', '<f8', n), ('time', '<i8', n), ('ele', '<f8', n),
+                              ('dist', '<i4', n), ('spd', '<f4', n), ('order', '<i4', n), ('counts', '<i4', len(ROUTE_LEVELS))):
+        columns[key] = np.frombuffer(buf, dtype, count, offset)
+        offset += columns[key].nbytes
+    columns['time'] = columns['time'].view('datetime64[s]')
+    columns['lod'] = {}
+    for z, count in zip(ROUTE_LEVELS, columns.pop('counts')):
+        columns['lod'][z] = np.frombuffer(buf, '<i4', count, offset)
+        offset += 4 * count
+    columns['bbox'] = tuple(bbox)
+    return columns
+
+
+# Данные маршрута без отображения: столбцы numpy, индекс для кликов, упрощения по масштабам
+class Track:
+    color = ROUTE_COLORS[0]  # цвет при рисовании без окна
 
-class Route:
     def __init__(self, fname):
         self.fname = fname
-        self.dates = []
-        self.times = []
-        self.lon = []
-        self.lat = []
-        self.spd = []
-        self.dist = []
-        self.pos = []  # (x,y)
+        # маршрут хранится столбцами numpy
+        self.lon = np.empty(0)  # градусы
+        self.lat = np.empty(0)
+        self.time = np.empty(0, 'datetime64[s]')
+        self.ele = np.empty(0)  # высота, м; NaN - нет в файле
+        self.spd = np.empty(0, np.float32)  # км/ч
+        self.dist = np.empty(0, np.int32)  # пройдено с начала, м
         self.start = 0  # начальный индекс
         self.finish = 0  # конечный индекс
-        self.sprite_start = load_sprite(-10, -10, 'start.png', alpha=True)
-        self.sprite_finish = load_sprite(-10, -10, 'finish.png', alpha=True)
+        self.bad_rows = []  # номера строк (точек) с ошибками
+        self.index = None  # поиск точки по клику
+        self.lod = {}  # упрощённый маршрут по масштабам
+        self.chunks = {}  # его куски с границами, для отсечения невидимого
+        self.bbox = None  # долгота мин/макс, широта мин/макс
+        self._stats = None
+        self.isRoute = self.load_route()
+        self.finish = max(len(self.lon) - 1, 0)
+        self.epoch = time_axis(self.time)  # ось времени, с
+        self.has_time = not np.isnat(self.time).all()
+
+    # статистика считается при первом обращении и хранится с маршрутом
+    @property
+    def stats(self):
+        if self._stats is None:
+            self._stats = TrackStats(self)
+        return self._stats
+
+    # итоги выбранного участка start..finish
+    def summary(self):
+        return self.stats.summary(self.start, self.finish)
+
+    # дата, время, скорость и пробег точки <i> - для подсказки
+    def record(self, i):
+        t = str(self.time[i])
+        date, tm = (t[:10], t[11:]) if t != 'NaT' else ('', '')
+        return [date, tm, f"{self.spd[i]:.1f}", int(self.dist[i])]
+
+    def load_csv(self):
+        with open(self.fname, 'rb') as csvfile:
+            csvfile.readline()  # DAT;LAT;LON;SPD;Metr
+            dat, num, self.bad_rows = read_csv_columns(csvfile.read())
+        self.time = to_datetime(dat)
+        self.lat = num[:, 0].copy()
+        self.lon = num[:, 1].copy()
+        self.spd = num[:, 2].astype(np.float32)
+        self.dist = num[:, 3].astype(np.int32)
+        self.ele = np.full(len(self.lon), np.nan)
+
+    # чтение GPX/KML прямо в массивы маршрута, скорость и пройденный путь считаем сами
+    def load_xml(self):
+        dat, lat, lon, ele = [], [], [], []
+        for dt, y, x, h in read_track_xml(self.fname):
+            dat.append(dt[:19])
+            lat.append(y)
+            lon.append(x)
+            ele.append(h)
+        if not dat:
+            return
+        self.lat, bad = to_array(np.array(lat), np.float64)
+        self.lon, bad_lon = to_array(np.array(lon), np.float64)
+        bad |= bad_lon
+        self.ele, no_ele = to_array(np.array(ele), np.float64)
+        self.ele[no_ele] = np.nan
+        self.time = to_datetime(dat)
+        if bad.any():
+            self.bad_rows = (np.flatnonzero(bad) + 1).tolist()
+            keep = ~bad
+            self.lat, self.lon, self.time, self.ele = self.lat[keep], self.lon[keep], self.time[keep], self.ele[keep]
+        d = np.concatenate(([0.0], distances(self.lat, self.lon)))
+        sec = np.concatenate(([0.0], np.diff(self.time).astype(np.float64)))
+        self.dist = (np.round(np.cumsum(d), 3) * 1000).astype(np.int32)
+        spd = np.zeros(len(d))
+        moving = sec > 0
+        spd[moving] = d[moving] * 1000 / sec[moving] * 3.6
+        self.spd = np.round(spd, 1).astype(np.float32)
+
+    def load_route(self):
+        cached = load_route_cache(self.fname)
+        if cached:
+            self.lon, self.lat, self.time, self.ele = cached['lon'], cached['lat'], cached['time'], cached['ele']
+            self.dist, self.spd, self.lod, self.bbox = cached['dist'], cached['spd'], cached['lod'], cached['bbox']
+            self.index = TrackIndex(self.lon, self.lat, cached['order'])
+            self.chunks = {z: chunk_boxes(self.lon[lod], self.lat[lod]) for z, lod in self.lod.items()}
+            return True
+        if self.fname.lower().endswith(('.gpx', '.xml', '.kml')):
+            self.load_xml()
+        else:
+            self.load_csv()
+        if self.bad_rows:
+            shown = ', '.join(map(str, self.bad_rows[:10])) + (', ...' if len(self.bad_rows) > 10 else '')
+            print(f"{self.fname}: пропущено строк с ошибками - {len(self.bad_rows)} ({shown})")
+        n = len(self.lon)
+        if not n:
+            return False
+        self.index = TrackIndex(self.lon, self.lat)
+        self.lod = simplify_levels(self.lon, self.lat)
+        self.chunks = {z: chunk_boxes(self.lon[lod], self.lat[lod]) for z, lod in self.lod.items()}
+        self.bbox = self.lon.min(), self.lon.max(), self.lat.min(), self.lat.max()
+        save_route_cache(self)
+        return True
+
+    # индекс точки маршрута не дальше <radius> пикселей от экранной точки <pos> (или None)
+    def nearest(self, mp, pos, radius):
+        if self.empty:
+            return None
+        lon, lat = mp.screen_to_geo(pos)
+        dlon, dlat = mp.map_size(lat)
+        return self.index.query(lon, lat, radius * dlon / 600, radius * dlat / 450, self.start, self.finish)
+
+    # выбрать участок между моментами DT1 и DT2 (datetime64 или строка 'ГГГГ.ММ.ДД чч:мм:сс'), None - без границы;
+    # False - в этом промежутке точек нет (участок становится пустым) или у маршрута нет времени (не меняется)
+    def build_route(self, DT1=None, DT2=None):
+        if not self.has_time:
+            return False
+        lo = 0 if DT1 is None else int(np.searchsorted(self.epoch, to_datetime([DT1]).astype(np.int64)[0]))
+        hi = len(self.epoch) - 1 if DT2 is None else \
+            int(np.searchsorted(self.epoch, to_datetime([DT2]).astype(np.int64)[0], 'right')) - 1
+        if lo > hi:
+            self.start, self.finish = 0, -1
+            return False
+        self.start, self.finish = lo, hi
+        return True
+
+    # выбранный участок пуст - маршрут не рисуется и не ищется
+    @property
+    def empty(self):
+        return self.finish < self.start
+
+
+# Маршрут на карте: данные плюс цвет и спрайты начала и конца
+class Route(Track):
+    def __init__(self, fname, color=ROUTE_COLORS[0]):
+        self.color = color
+        self.sprite_start = load_sprite(-10, -10, 'Start.png', alpha=True)
+        self.sprite_finish = load_sprite(-10, -10, 'Finish.png', alpha=True)
         all_sprites.add(self.sprite_start)
         all_sprites.add(self.sprite_finish)
-        self.points = dict()
-        self.isRoute = self.load_route()
+        self.addresses = {}  # индекс точки -> Future её адреса (см. GEOCODE_EVERY)
+        super().__init__(fname)
+
+    # флажки - на начало и конец выбранного участка
+    def place_sprites(self, mp):
+        if self.empty:
+            self.sprite_start.rect.topleft = self.sprite_finish.rect.topleft = (-100, -100)
+            return
+        x, y = mp.geo_to_screen(self.lon[self.start], self.lat[self.start])
+        self.sprite_start.rect.x = x - 12
+        self.sprite_start.rect.y = y - 12
+        x, y = mp.geo_to_screen(self.lon[self.finish], self.lat[self.finish])
+        self.sprite_finish.rect.x = x - 12
+        self.sprite_finish.rect.y = y - 12
 
     def free(self):
         all_sprites.remove(self.sprite_start)
         all_sprites.remove(self.sprite_finish)
+        for future in self.addresses.values():
+            future.cancel()  # адреса ещё не запрошенных точек больше не нужны
 
-    def xml_to_csv(self):
-        with open(self.fname) as xml_file:
-            csv_txt = 'DAT;LAT;LON;SPD;Metr\n'
-            tree = ET.parse(self.fname)
-            root = tree.getroot()
-            t1 = 0
-            lat1 = float(root[1][4][0].attrib['lat'])
-            lon1 = float(root[1][4][0].attrib['lon'])
-            s = 0
-            for child in root[1][4]:
-                dt = child[1].text.replace('T', ' ')
-                csv_txt += str(dt[:19]) + ';' + child.attrib['lat'] + ';' + child.attrib['lon'] + ';'
-
-                dt = dt[11:19].split(':')
-                t2 = int(dt[0]) * 3600 + int(dt[1]) * 60 + int(dt[2])
-                if t1 != 0:
-                    dt = t2 - t1
-                else:
-                    dt = 0
-                t1 = t2
-
-                lat2 = float(child.attrib['lat'])
-                lon2 = float(child.attrib['lon'])
-                if lat1 != root[1][4][0].attrib['lat'] and lon1 != root[1][4][0].attrib['lon']:
-                    s += distance(lat1, lon1, lat2, lon2)
-                    if dt != 0:
-                        csv_txt += str(round(distance(lat1, lon1, lat2, lon2) * 1000 / dt * 3.6, 1)) + ';'
-                    else:
-                        csv_txt += str(0) + ';'
-                    csv_txt += str(int(round(s, 3) * 1000)) + '\n'
-                else:
-                    csv_txt += str(0) + '\n'
-                lat1 = float(lat2)
-                lon1 = float(lon2)
-            new_file = open(self.fname[:len(self.fname) - 4] + '.csv', 'w')
-            new_file.write(csv_txt)
-            new_file.close()
-        self.fname = self.fname[:len(self.fname) - 4] + '.csv'
 
-    def load_route(self):
-        if self.fname[len(self.fname) - 4:] == '.gpx' or self.fname[len(self.fname) - 4:] == '.xml':
-            self.xml_to_csv()
-
-        with open(self.fname) as csvfile:
-            reader = csv.reader(csvfile, delimiter=';', quotechar=None)
-            title = next(reader)  # DAT;LAT;LON;SPD;Metr
-            l = len(title)
-            k = 1
-            for row in reader:
-                if len(row) < l:
-                    continue
-                k += 1
-                try:
-                    dt = row[0].split()
-                    self.dates.append(dt[0])
-                    self.times.append(dt[1])
-                    self.lon.append(float(row[2]))
-                    self.lat.append(float(row[1]))
-                    self.spd.append(row[3])
-                    self.dist.append(int(row[4]))
-                    if (k - 1) % 5 == 0:
-                        self.points[(float(row[1][:7]) * 10000, float(row[2][:7]) * 10000)] = [dt[0], dt[1], row[3],
-                                                                                               int(row[4])]
-                    self.pos.append((None, None))  # пока не знаем
-                except Exception:
-                    print('Ошибка в файле в строке', k)
-            lon_min = min(self.lon)
-            lon_max = max(self.lon)
-            lat_min = min(self.lat)
-            lat_max = max(self.lat)
-            lon_centr = (lon_min + lon_max) / 2
-            lat_centr = (lat_min + lat_max) / 2
-            d_lon = lon_max - lon_min
-            d_lat = lat_max - lat_min
-            mp.lon = lon_centr
-            mp.lat = lat_centr
-            bad_size = True
-            while bad_size:
-                dlon, dlat = mp.map_size()
-                if (dlon * 1.8 > d_lon) and (dlat * 2 > d_lat):
-                    bad_size = False
-                    while (dlon * 0.9 > d_lon) and (dlat > d_lat):
-                        if mp.zoom < 19:
-                            mp.zoom += 1
-                            dlon, dlat = mp.map_size()
-                        else:
-                            break
+# Несколько маршрутов на одной карте, у каждого свой цвет
+class Routes:
+    def __init__(self):
+        self.items = []
+        self.version = 0  # меняется при каждой загрузке - слой маршрутов надо перерисовать
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+    def free(self):
+        for route in self.items:
+            route.free()
+        self.items = []
+        self.version += 1
+
+    # загрузить файлы вместо прежних маршрутов и подогнать карту под все сразу; True - что-то загрузили
+    def load(self, fnames):
+        self.free()
+        for fname in fnames:
+            route = Route(fname, ROUTE_COLORS[len(self.items) % len(ROUTE_COLORS)])
+            if route.isRoute:
+                self.items.append(route)
+                print(os.path.basename(fname) + ':', summary_text(route.summary()))
+                if GEOCODE_EVERY:
+                    route.addresses = geocoder.reverse_track(route, GEOCODE_EVERY)
+            else:
+                route.free()
+        if not self.items:
+            return False
+        boxes = np.array([route.bbox for route in self.items])
+        # если все не поместились, остаёмся на самом мелком масштабе - что-то да будет видно
+        fit_map(mp, boxes[:, 0].min(), boxes[:, 1].max(), boxes[:, 2].min(), boxes[:, 3].max())
+        return True
+
+    # показать у всех маршрутов только участки от DT1 до DT2; True - хоть у одного такой участок есть
+    def build_route(self, DT1=None, DT2=None):
+        found = False
+        for route in self.items:
+            if route.build_route(DT1, DT2):
+                found = True
+                print(os.path.basename(route.fname) + ':', summary_text(route.summary()))
+            elif route.empty:
+                print(os.path.basename(route.fname) + ': в этом промежутке точек нет')
+        self.version += 1
+        return found
+
+    # (маршрут, индекс точки), ближайшей к экранной точке <pos>, или (None, None)
+    def nearest(self, mp, pos, radius):
+        best, best_d = (None, None), None
+        for route in self.items:
+            i = route.nearest(mp, pos, radius)
+            if i is not None:
+                x, y = mp.geo_to_screen(route.lon[i], route.lat[i])
+                d = (x - pos[0]) ** 2 + (y - pos[1]) ** 2
+                if best_d is None or d < best_d:
+                    best, best_d = (route, i), d
+        return best
+
+
+# Проигрывание маршрута в PLAY_SPEED раз быстрее: флажок конца едет по маршруту, а на слой маршрутов
+# каждый кадр дорисовывается только пройденный за кадр отрезок
+class Playback:
+    def __init__(self):
+        self.route = None  # проигрываемый маршрут, None - не проигрываем
+        self.paused = None  # маршрут на паузе
+        self.speed = PLAY_SPEED
+        self.t = 0  # момент маршрута, с эпохи
+        self.end = 0  # последняя точка выбранного участка
+        self.tick = 0.0  # время прошлого кадра
+
+    # начать с начала выбранного участка / пауза / продолжить; True - слой маршрутов надо перерисовать
+    def toggle(self, route):
+        if self.route:
+            self.paused, self.route = self.route, None
+            return False
+        self.tick = time.monotonic()
+        if self.paused is route and route.finish < self.end:
+            self.route, self.paused = route, None
+            self.t = route.epoch[route.finish]
+            return False
+        if not route.has_time:
+            print('В маршруте нет времени:', route.fname)
+            return False
+        if route.empty:
+            print('В выбранном промежутке у маршрута нет точек:', route.fname)
+            return False
+        self.route, self.paused = route, None
+        self.end = route.finish
+        route.finish = route.start
+        self.t = route.epoch[route.start]
+        routes.version += 1
+        return True
+
+    # остановить совсем и снова показать весь выбранный участок
+    def stop(self):
+        route = self.route or self.paused
+        if route:
+            route.finish = self.end
+            routes.version += 1
+        self.route = self.paused = None
+
+    def frame(self, mp):
+        now = time.monotonic()
+        self.t += (now - self.tick) * self.speed
+        self.tick = now
+        route = self.route
+        i = min(int(np.searchsorted(route.epoch, self.t, 'right')) - 1, self.end)
+        if i > route.finish:
+            xs, ys = mp.geo_to_screen_arr(route.lon[route.finish:i + 1], route.lat[route.finish:i + 1])
+            rect = pygame.draw.lines(layers.overlay, route.color, False, np.column_stack((xs, ys)).tolist(), 5)
+            route.finish = i
+            old = route.sprite_finish.rect.copy()
+            route.sprite_finish.rect.center = (int(xs[-1]), int(ys[-1]))
+            layers.refresh(layers.compose(rect), old, route.sprite_finish.rect)
+        if i >= self.end:
+            self.route = None
+
+
+# центр и масштаб карты, чтобы поместилась область от <lon_min>, <lat_min> до <lon_max>, <lat_max>
+def fit_map(mp, lon_min, lon_max, lat_min, lat_max):
+    lon_centr = (lon_min + lon_max) / 2
+    lat_centr = (lat_min + lat_max) / 2
+    d_lon = lon_max - lon_min
+    d_lat = lat_max - lat_min
+    mp.lon = lon_centr
+    mp.lat = lat_centr
+    bad_size = True
+    while bad_size:
+        dlon, dlat = mp.map_size()
+        if (dlon * 1.8 > d_lon) and (dlat * 2 > d_lat):
+            bad_size = False
+            while (dlon * 0.9 > d_lon) and (dlat > d_lat):
+                if mp.zoom < 19:
+                    mp.zoom += 1
+                    dlon, dlat = mp.map_size()
                 else:
-                    if mp.zoom > 6:
-                        mp.zoom -= 1
-                    else:
-                        return False  # что-то здесь не то
+                    break
+        else:
+            if mp.zoom > 6:
+                mp.zoom -= 1
+            else:
+                return False  # что-то здесь не то
+    return True
+
+
+# Куски вдоль маршрута на масштабах <zooms>: виды с центром на маршруте через полвида (размеры вида -
+# по map_size()), все куски каждого вида, без повторов. Результат упорядочен по масштабу
+def corridor_tiles(track, zooms):
+    mp = Map()
+    found = set()
+    for z in zooms:
+        mp.zoom = z
+        lod = track.lod[min(max(z, 5), 19)]  # мельче пикселя точки не нужны
+        lon, lat = track.lon[lod], track.lat[lod]
+        dlon, dlat = mp.map_size(0)
+        dlat = dlat * np.cos(np.radians(lat[:-1]))
+        steps = np.maximum(np.ceil(np.maximum(np.abs(np.diff(lon)) / (dlon / 2),
+                                              np.abs(np.diff(lat)) / (dlat / 2))), 1).astype(int)
+        seg = np.repeat(np.arange(len(steps)), steps)
+        t = (np.arange(len(seg)) - np.repeat(np.cumsum(steps) - steps, steps)) / np.repeat(steps, steps)
+        lon = np.append(lon[seg] + t * (lon[seg + 1] - lon[seg]), lon[-1]) if len(seg) else lon
+        lat = np.append(lat[seg] + t * (lat[seg + 1] - lat[seg]), lat[-1]) if len(seg) else lat
+        for mp.lon, mp.lat in zip(lon.tolist(), lat.tolist()):
+            found.update((z, x, y) for z, x, y, _, _ in mp.tiles())
+    return sorted(found)
+
+
+# Заранее загрузить в дисковый кэш куски карты вдоль маршрутов <fnames>. Уже загруженные пропускаются,
+# так что прерванную загрузку можно просто запустить снова
+def seed_tiles(fnames, zooms, workers, estimate_only=False):
+    wanted = set()
+    for fname in fnames:
+        track = Track(fname)
+        if track.isRoute:
+            wanted.update(corridor_tiles(track, zooms))
+        else:
+            print('Маршрут не прочитан:', fname)
+    todo = sorted(zxy for zxy in wanted if TileCache.key(tiles.name, *zxy) not in tile_cache)
+    tile_bytes = tile_cache.disk_size // len(tile_cache.disk) if len(tile_cache.disk) >= 20 else SEED_TILE_BYTES
+    for z in zooms:
+        n = sum(1 for zxy in wanted if zxy[0] == z)
+        print(f"Z{z}: кусков {n}, загрузить {sum(1 for zxy in todo if zxy[0] == z)}")
+    print(f"Всего кусков {len(wanted)}, уже есть {len(wanted) - len(todo)}, "
+          f"загрузить {len(todo)} - около {len(todo) * tile_bytes / 2 ** 20:.1f} МБ")
+    if tile_cache.disk_size + len(todo) * tile_bytes > tile_cache.disk_bytes:
+        print(f"Не поместится в кэш ({tile_cache.disk_bytes / 2 ** 20:.0f} МБ, CACHE_DISK_BYTES) - "
+              "уменьшите диапазон масштабов")
+        return False
+    if estimate_only:
         return True
+    return download_tiles(todo, workers)
+
+
+# загрузить куски <todo> в кэш в <workers> потоков, с печатью хода; False - были ошибки или загрузку прервали
+def download_tiles(todo, workers):
+    if not todo:
+        return True
+    pool = ThreadPoolExecutor(max_workers=workers)
+    jobs = [pool.submit(load_map, tiles, z, x, y, True) for z, x, y in todo]
+    done = failed = 0
+    try:
+        for job in as_completed(jobs):
+            done += 1
+            failed += job.result() is None
+            if done % 50 == 0 or done == len(jobs):
+                print(f"\rзагружено {done} из {len(jobs)}, ошибок {failed}", end='', flush=True)
+    except KeyboardInterrupt:
+        print('\nПрервано - при повторном запуске загрузка продолжится')
+        pool.shutdown(wait=True, cancel_futures=True)
+        return False
+    pool.shutdown()
+    print()
+    return not failed
+
+
+# python Map_route.py --seed маршрут.gpx [...] --source URL [--zoom 10-16] [--workers 4] [--estimate]
+def seed_main(argv):
+    global tile_cache, tiles
+    parser = argparse.ArgumentParser(prog='Map_route.py --seed',
+                                     description='Заранее загрузить куски карты вдоль маршрутов для работы без сети')
+    parser.add_argument('tracks', nargs='+', help='файлы маршрутов (csv, gpx, kml)')
+    parser.add_argument('--zoom', default='10-16', help='масштаб или диапазон масштабов, например 12-16')
+    parser.add_argument('--source', required=True, help='адрес кусков карты (свой сервер, не общий OSM)')
+    parser.add_argument('--workers', type=int, default=4, help='одновременных загрузок')
+    parser.add_argument('--estimate', action='store_true', help='только посчитать куски и объём')
+    args = parser.parse_args(argv)
+    lo, _, hi = args.zoom.partition('-')
+    try:
+        zooms = range(int(lo), int(hi or lo) + 1)
+    except ValueError:
+        parser.error('масштаб - число или диапазон, например 12-16')
+    if not zooms or zooms[0] < 5 or zooms[-1] > 19:
+        parser.error('масштабы карты - от 5 до 19')
+    tile_cache = TileCache()
+    tiles = make_tiles(args.source)
+    if tiles.local:
+        parser.error('источник и так на диске')
+    if not bulk_allowed(tiles):
+        parser.error(f"{urlsplit(args.source).hostname} не разрешает массовую загрузку - укажите свой сервер")
+    return seed_tiles(args.tracks, zooms, args.workers, args.estimate)
+
+
+# Вид карты под маршрут <fname>, как при загрузке в окне: (fname, (lon, lat, zoom), куски вида);
+# вид None - маршрут не прочитан
+def plan_render(fname):
+    track = Track(fname)
+    if not track.isRoute:
+        return fname, None, []
+    mp = Map()
+    fit_map(mp, *track.bbox)
+    return fname, (mp.lon, mp.lat, mp.zoom), [(z, x, y) for z, x, y, _, _ in mp.tiles()]
 
-    def build_route(DT1=None, DT2=None):
-        load_4picture(mp)
+
+# Картинка маршрута <fname> с видом <view> в файл <out>, без окна: карта, маршрут, флажки начала и конца;
+# <width> - уменьшить до этой ширины
+def render_png(fname, view, out, width=0):
+    track = Track(fname)
+    mp = Map()
+    mp.lon, mp.lat, mp.zoom = view
+    surface = pygame.Surface((VIEW_W, VIEW_H))
+    surface.fill((200, 200, 200))
+    for z, x, y, sx, sy in mp.tiles():
+        load_picture(decode_tile(load_map(tiles, z, x, y, quiet=True)), sx, sy, surface)
+    draw_route(mp, track, surface)
+    for i, name in ((track.start, 'Start.png'), (track.finish, 'Finish.png')):
+        image = pygame.image.load(os.path.join('Images', name))
+        image.set_colorkey(image.get_at((0, 0)))
+        x, y = mp.geo_to_screen(track.lon[i], track.lat[i])
+        surface.blit(image, (x - 12, y - 12))
+    if width and width != VIEW_W:
+        surface = pygame.transform.smoothscale(surface, (width, VIEW_H * width // VIEW_W))
+    pygame.image.save(surface, out)
+    return out
+
+
+# у каждого процесса - свой источник и свой TileCache над общим каталогом кэша
+def render_worker_init(source):
+    global tile_cache, tiles
+    tile_cache = TileCache()
+    tiles = make_tiles(source)
+
+
+# python Map_route.py --render data gpx --source URL [--out thumbs] [--width 540] [--workers N]
+def render_main(argv):
+    global tile_cache, tiles
+    parser = argparse.ArgumentParser(prog='Map_route.py --render',
+                                     description='Картинки маршрутов без окна: по файлу PNG на каждый маршрут')
+    parser.add_argument('paths', nargs='+', help='каталоги или файлы маршрутов (csv, gpx, kml, xml)')
+    parser.add_argument('--out', default='thumbs', help='куда сложить картинки')
+    parser.add_argument('--width', type=int, default=0, help='ширина картинки, px (по умолчанию - как карта в окне)')
+    parser.add_argument('--source', required=True, help='адрес, каталог или .mbtiles кусков карты')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='процессов рисования')
+    parser.add_argument('--downloads', type=int, default=4, help='одновременных загрузок кусков')
+    args = parser.parse_args(argv)
+    fnames = []
+    for path in args.paths:
+        names = [os.path.join(path, name) for name in sorted(os.listdir(path))] if os.path.isdir(path) else [path]
+        fnames += [name for name in names if name.lower().endswith(('.csv', '.gpx', '.kml', '.xml'))]
+    if not fnames:
+        parser.error('маршрутов не найдено')
+    os.makedirs(args.out, exist_ok=True)
+    tile_cache = TileCache()
+    tiles = make_tiles(args.source)
+    if not bulk_allowed(tiles):
+        parser.error(f"{urlsplit(args.source).hostname} не разрешает массовую загрузку - укажите свой сервер, "
+                     f"каталог или .mbtiles")
+    started = time.perf_counter()
+    with ProcessPoolExecutor(args.workers, initializer=render_worker_init, initargs=(args.source,)) as pool:
+        plans = [plan for plan in pool.map(plan_render, fnames) if plan[1]]
+        # общие для нескольких маршрутов куски загружаются один раз, заранее, в общий кэш
+        wanted = {zxy for _, _, zxys in plans for zxy in zxys}
+        todo = [] if tiles.local else sorted(zxy for zxy in wanted if TileCache.key(tiles.name, *zxy) not in tile_cache)
+        print(f"Маршрутов {len(plans)} из {len(fnames)}, кусков карты {len(wanted)}, загрузить {len(todo)}")
+        download_tiles(todo, args.downloads)
+        jobs = [pool.submit(render_png, fname, view, os.path.join(args.out, os.path.basename(fname) + '.png'),
+                            args.width) for fname, view, _ in plans]
+        done = 0
+        for job in as_completed(jobs):
+            try:
+                job.result()
+                done += 1
+            except Exception as e:
+                print('Ошибка рисования:', e)
+    print(f"Картинок {done} за {time.perf_counter() - started:.1f} с в {args.out}")
+    return done == len(plans)
 
 
 # ---- Окно для ввода разного текста ----
@@ -490,6 +1984,19 @@ def input_coord():
         return None
 
 
+# Ввод промежутка времени: (с, по), пустая граница - None; отказ от ввода - None
+def input_time_range():
+    global input_str
+    input_text("Промежуток времени", "с, по (ГГГГ.ММ.ДД чч:мм:сс, ч-з запятую; пусто - без границы)")
+    if input_str is None:
+        return None
+    bounds = [part.strip() or None for part in (input_str.split(',') + [''])[:2]]
+    if any(b is not None and np.isnat(to_datetime([b])[0]) for b in bounds):
+        print('Непонятное время:', input_str)
+        return None
+    return bounds
+
+
 # Ввод адреса
 def input_adres():
     global input_str
@@ -500,25 +2007,53 @@ def input_adres():
 
 
 # Печать всех строк на правом боку формы
+PANEL_LABELS = (("Центр карты:", 16, 1093, 75), ("Увеличить", 20, 1093, 562), ("шаг", 20, 1121, 581))
+
+
 def print_txt(mp):
-    write_text("Центр карты:".format(mp.lat), 16, (255, 255, 255), 1093, 75)
+    for text, size, x, y in PANEL_LABELS:
+        write_text(text, size, (255, 255, 255), x, y)
     write_text("Ш:{:10.6f}".format(mp.lat), 15, (255, 255, 255), 1093, 97)
     write_text("Д:{:10.6f}".format(mp.lon), 15, (255, 255, 255), 1096, 115)
-    write_text("Увеличить", 20, (255, 255, 255), 1093, 562)
-    write_text("шаг", 20, (255, 255, 255), 1121, 581)
     write_text(f"Z:{mp.zoom}", 22, (255, 255, 255), 1118, 786)
 
 
+# замеры прошлого кадра на правом боку, между «Увеличить шаг» и кнопкой «+»; числа меняются каждый кадр,
+# поэтому мимо кэша надписей
+def print_profile():
+    font = get_font(12)
+    pygame.draw.rect(screen, (40, 52, 64), ((1086, 603), (108, 114)))
+    for i, line in enumerate(profiler.lines()):
+        screen.blit(font.render(line, True, (255, 255, 160)), (1090, 604 + i * 14))
+
+
 # -------------------------- MAIN -------------------
 if __name__ == "__main__":
+    multiprocessing.freeze_support()  # в собранном exe (Map_route.spec) процессы --render иначе открыли бы окно
+    if len(sys.argv) > 1 and sys.argv[1] == '--seed':
+        sys.exit(0 if seed_main(sys.argv[2:]) else 1)
+    if len(sys.argv) > 1 and sys.argv[1] == '--render':
+        sys.exit(0 if render_main(sys.argv[2:]) else 1)
     pygame.init()
     screen = pygame.display.set_mode((1200, 900))
     pygame.display.set_caption('Карта путешествий')
+    pygame.key.set_repeat(300, 40)  # зажатая стрелка двигает карту
     clock = pygame.time.Clock()
+    for text, size, _, _ in PANEL_LABELS:
+        render_text(text, size, (255, 255, 255))  # неизменные надписи - заранее
+    info_cloud = InfoCloud()
+    tile_cache = TileCache()
+    surface_pool = SurfacePool()
+    tiles = make_tiles(sys.argv[1] if len(sys.argv) > 1 else TILE_URL)  # можно указать каталог или .mbtiles
+    prefetcher = Prefetcher()
+    tile_loader = TileLoader()
+    geocoder = Geocoder()
     mp = Map()
     mp.lat = 46.30774
     mp.lon = 44.26976
-    route = None  # маршрута нет
+    routes = Routes()  # маршрутов нет
+    playback = Playback()
+    layers = Layers()
     all_sprites = pygame.sprite.Group()
     load_4picture(mp)
     cloud = None
@@ -541,115 +2076,140 @@ if __name__ == "__main__":
     button_left = Button(1093, 425, "btnLeft0.png", "btnLeft1.png")
     button_right = Button(1143, 425, "btnRight0.png", "btnRight1.png")
     print_txt(mp)
-    BigStep = False
 
     running = True
     while running:
-        event = pygame.event.wait()
-        if event.type == pygame.QUIT:
-            running = False
-            break
-        elif event.type == pygame.KEYDOWN:
-            if cloud:
-                all_sprites.remove(cloud)
-            mp.update(event.key)
-        elif event.type == pygame.MOUSEBUTTONDOWN:
-            if cloud:
-                all_sprites.remove(cloud)
-            if button_coord.sprite().rect.collidepoint(event.pos):
-                button_coord.set_active(True)
-                coord = input_coord()
-                if coord:
-                    if (-75 < coord[0] < 80) and (-180 <= coord[1] <= 180):
-                        mp.lon, mp.lat = coord
-                        load_4picture(mp)
-                button_coord.set_active(False)
-            elif button_adres.sprite().rect.collidepoint(event.pos):
-                button_adres.set_active(True)
-                coord = input_adres()
-                if coord:
-                    if (-75 < coord[0] < 80) and (-180 <= coord[1] <= 180):
-                        mp.lon, mp.lat = coord
+        # всё накопившееся разбираем разом: нажатия стрелок только сдвигают вид, а карта
+        # собирается один раз - для последнего из них
+        moved = False
+        # во время проигрывания не ждём событий - кадры идут сами
+        for event in pygame.event.get() if playback.route else [pygame.event.wait()] + pygame.event.get():
+            if event.type == pygame.QUIT:
+                running = False
+                break
+            elif event.type == TILE_LOADED:
+                if event.key == layers.base_key:  # кусок прежнего вида не нужен
+                    show_tile(event.img, *event.pos)
+            elif event.type == GEOCODED:
+                if event.search_id == mp.search_id:
+                    mp.search_result = SearchResult(event.point, event.address)
+                    load_4picture(mp)
+            elif event.type == pygame.KEYDOWN:
+                if cloud:
+                    all_sprites.remove(cloud)
+                    layers.refresh(cloud.rect)
+                    cloud = None
+                if event.key == pygame.K_t and len(routes):  # показать участок по времени
+                    playback.stop()
+                    time_range = input_time_range()
+                    if time_range:
+                        routes.build_route(*time_range)
+                    load_4picture(mp)
+                elif event.key == pygame.K_p and len(routes):  # проиграть выбранный участок / пауза
+                    if playback.toggle(routes.items[0]):
                         load_4picture(mp)
-                button_adres.set_active(False)
-            elif button_load.sprite().rect.collidepoint(event.pos):
-                if not button_load.active:
-                    button_load.set_active(True)
-                    csv_file = select_File()
-                    if csv_file:
-                        if route:
-                            route.free()
-                        route = Route(csv_file)
-                        if route:
-                            if route.isRoute:
-                                load_4picture(mp)
-                    button_load.set_active(False)
-            elif button_plus.sprite().rect.collidepoint(event.pos):
-                button_plus.set_active(True)
-                mp.update(pygame.K_PAGEUP)
-                button_plus.set_active(False)
-            elif button_minus.sprite().rect.collidepoint(event.pos):
-                button_minus.set_active(True)
-                mp.update(pygame.K_PAGEDOWN)
-                button_minus.set_active(False)
-            elif button_left.sprite().rect.collidepoint(event.pos):
-                button_left.set_active(True)
-                mp.update(pygame.K_LEFT)
-                button_left.set_active(False)
-            elif button_right.sprite().rect.collidepoint(event.pos):
-                button_right.set_active(True)
-                mp.update(pygame.K_RIGHT)
-                button_right.set_active(False)
-            elif button_up.sprite().rect.collidepoint(event.pos):
-                button_up.set_active(True)
-                mp.update(pygame.K_UP)
-                button_up.set_active(False)
-            elif button_down.sprite().rect.collidepoint(event.pos):
-                button_down.set_active(True)
-                mp.update(pygame.K_DOWN)
-                button_down.set_active(False)
-            elif button_check.sprite().rect.collidepoint(event.pos):
-                BigStep = not button_check.active
-                button_check.set_active(BigStep)
-            else:
-                if event.button == 1:  # LEFT_MOUSE_BUTTON
-                    # print(screen.get_at((event.pos[0], event.pos[1])))
-                    if (0 <= event.pos[0] < 1080) and (0 <= event.pos[1] < 900):
-                        mp.add_reverse_toponym_search(event.pos)
-                        lon_point, lat_point = mp.screen_to_geo((event.pos[0], event.pos[1]))
-                        if ((screen.get_at((event.pos[0], event.pos[1])) == (255, 0, 0) or
-                                screen.get_at((event.pos[0], event.pos[1])) == (255, 255, 0))) and \
-                                ((int(lat_point * 10000), int(lon_point * 10000)) in route.points):
-                            # print(mp.screen_to_geo((event.pos[0], event.pos[1])))
-                            # pprint.pprint(route.points)
-                            # дата, время, скорость, разгон
-                            date_point = route.points[(int(lat_point * 10000), int(lon_point * 10000))][0]
-                            time_point = route.points[(int(lat_point * 10000), int(lon_point * 10000))][1]
-                            spd_point = route.points[(int(lat_point * 10000), int(lon_point * 10000))][2]
-                            metr_point = route.points[(int(lat_point * 10000), int(lon_point * 10000))][3]
-
-                            img = Image.open('Images/info_cloud.png')
-                            font_img = ImageFont.truetype('fonts/arial.ttf', size=9)
-                            draw_img = ImageDraw.Draw(img)
-                            draw_img.text((64, 21), time_point[:5], font=font_img, fill=(0, 0, 0))
-                            draw_img.text((53, 57), date_point[2:], font=font_img, fill=(0, 0, 0))
-                            draw_img.text((167, 21), spd_point, font=font_img, fill=(0, 0, 0))
-                            draw_img.text((162, 58), str(metr_point), font=font_img, fill=(0, 0, 0))
-                            img.save('Images/info_cloud_tmp.png')
-
-                            cloud = load_sprite(event.pos[0] - 158, event.pos[1] - 105, 'info_cloud_tmp.png', True)
-                            all_sprites.add(cloud)
-                            if os.path.exists(os.getcwd() + '\\Images\\info_cloud_tmp.png'):
-                                os.remove(os.getcwd() + '\\Images\\info_cloud_tmp.png')
-                            print(route.points[(int(lat_point * 10000), int(lon_point * 10000))])
-                        if mp.search_result:
+                elif event.key == pygame.K_RIGHTBRACKET:
+                    playback.speed *= 2
+                elif event.key == pygame.K_LEFTBRACKET:
+                    playback.speed = max(playback.speed / 2, 1)
+                elif event.key == pygame.K_F2:  # замеры по этапам на панели
+                    profiler.enabled = not profiler.enabled
+                    load_4picture(mp)
+                elif event.key == pygame.K_F3:  # трассировка в файл: начать / записать
+                    fname = profiler.toggle_trace()
+                    if fname:
+                        print('Трассировка записана в', fname)
+                    else:
+                        print('Трассировка начата')
+                else:
+                    moved = mp.step(event.key) or moved
+            elif event.type == pygame.MOUSEBUTTONDOWN:
+                if cloud:
+                    all_sprites.remove(cloud)
+                    layers.refresh(cloud.rect)
+                    cloud = None
+                if button_coord.sprite().rect.collidepoint(event.pos):
+                    button_coord.set_active(True)
+                    coord = input_coord()
+                    if coord:
+                        if (-75 < coord[0] < 80) and (-180 <= coord[1] <= 180):
+                            mp.lon, mp.lat = coord
                             load_4picture(mp)
-                elif event.button == 3:  # RIGHT_MOUSE_BUTTON
-                    if (0 <= event.pos[0] < 1080) and (0 <= event.pos[1] < 900):
-                        point = mp.screen_to_geo(event.pos)
-                        if point:
-                            mp.lon, mp.lat = point
+                    button_coord.set_active(False)
+                elif button_adres.sprite().rect.collidepoint(event.pos):
+                    button_adres.set_active(True)
+                    coord = input_adres()
+                    if coord:
+                        if (-75 < coord[0] < 80) and (-180 <= coord[1] <= 180):
+                            mp.lon, mp.lat = coord
                             load_4picture(mp)
+                    button_adres.set_active(False)
+                elif button_load.sprite().rect.collidepoint(event.pos):
+                    if not button_load.active:
+                        button_load.set_active(True)
+                        csv_files = select_File()
+                        if csv_files:
+                            playback.stop()
+                            if routes.load(csv_files):
+                                load_4picture(mp)
+                        button_load.set_active(False)
+                elif button_plus.sprite().rect.collidepoint(event.pos):
+                    button_plus.set_active(True)
+                    mp.update(pygame.K_PAGEUP)
+                    button_plus.set_active(False)
+                elif button_minus.sprite().rect.collidepoint(event.pos):
+                    button_minus.set_active(True)
+                    mp.update(pygame.K_PAGEDOWN)
+                    button_minus.set_active(False)
+                elif button_left.sprite().rect.collidepoint(event.pos):
+                    button_left.set_active(True)
+                    mp.update(pygame.K_LEFT)
+                    button_left.set_active(False)
+                elif button_right.sprite().rect.collidepoint(event.pos):
+                    button_right.set_active(True)
+                    mp.update(pygame.K_RIGHT)
+                    button_right.set_active(False)
+                elif button_up.sprite().rect.collidepoint(event.pos):
+                    button_up.set_active(True)
+                    mp.update(pygame.K_UP)
+                    button_up.set_active(False)
+                elif button_down.sprite().rect.collidepoint(event.pos):
+                    button_down.set_active(True)
+                    mp.update(pygame.K_DOWN)
+                    button_down.set_active(False)
+                elif button_check.sprite().rect.collidepoint(event.pos):
+                    mp.big_step = not button_check.active
+                    button_check.set_active(mp.big_step)
+                else:
+                    if event.button == 1:  # LEFT_MOUSE_BUTTON
+                        # print(screen.get_at((event.pos[0], event.pos[1])))
+                        if (0 <= event.pos[0] < 1080) and (0 <= event.pos[1] < 900):
+                            mp.add_reverse_toponym_search(event.pos)
+                            route, i_point = routes.nearest(mp, event.pos, CLICK_RADIUS)
+                            if route:
+                                # дата, время, скорость, разгон
+                                record = route.record(i_point)
+                                cloud = info_cloud.sprite(record, event.pos[0] - 158, event.pos[1] - 105)
+                                all_sprites.add(cloud)
+                                print(*record)
+                                layers.refresh(cloud.rect)
+                    elif event.button == 3:  # RIGHT_MOUSE_BUTTON
+                        if (0 <= event.pos[0] < 1080) and (0 <= event.pos[1] < 900):
+                            point = mp.screen_to_geo(event.pos)
+                            if point:
+                                mp.lon, mp.lat = point
+                                mp.correct_lat()
+                                load_4picture(mp)
 
+        if running and moved:
+            load_4picture(mp)
+        if running and playback.route:
+            playback.frame(mp)
         clock.tick(50)
+    print('Кэш карты:', tile_cache.stats())
+    print('Готовые куски:', surface_pool.stats())
+    print('Адреса:', geocoder.stats())
+    if profiler.tracing:
+        print('Трассировка записана в', profiler.toggle_trace())
+    geocoder.close()
     pygame.quit()
@@ -0,0 +1,73 @@
+# Сравнение загрузки CSV: прежний построчный разбор из load_route и разбор столбцами numpy
+# запуск: python benchmarks/bench_csv.py [файл.csv] [повторов]
+import os
+import sys
+import csv
+import time
+
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from Map_route import read_csv_columns, read_csv_fast, to_datetime  # noqa: E402
+
+
+# прежний load_route без подгонки карты: csv.reader, списки, словарь точек для поиска по клику,
+# заготовки экранных координат и границы маршрута
+def load_rows(fname):
+    dates, times, lon, lat, spd, dist, points, pos = [], [], [], [], [], [], {}, []
+    with open(fname) as csvfile:
+        reader = csv.reader(csvfile, delimiter=';', quotechar=None)
+        title = next(reader)  # DAT;LAT;LON;SPD;Metr
+        l = len(title)
+        k = 1
+        for row in reader:
+            if len(row) < l:
+                continue
+            k += 1
+            try:
+                dt = row[0].split()
+                dates.append(dt[0])
+                times.append(dt[1])
+                lon.append(float(row[2]))
+                lat.append(float(row[1]))
+                spd.append(row[3])
+                dist.append(int(row[4]))
+                if (k - 1) % 5 == 0:
+                    points[(float(row[1][:7]) * 10000, float(row[2][:7]) * 10000)] = [dt[0], dt[1], row[3],
+                                                                                           int(row[4])]
+                pos.append((None, None))  # пока не знаем
+            except Exception:
+                print('Ошибка в файле в строке', k)
+        bbox = min(lon), max(lon), min(lat), max(lat)
+    return lon, bbox
+
+
+# как Track.load_csv: столбцы, время и границы маршрута
+def load_columns(fname):
+    with open(fname, 'rb') as csvfile:
+        csvfile.readline()
+        dat, num, bad = read_csv_columns(csvfile.read())
+    bbox = num[:, 1].min(), num[:, 1].max(), num[:, 0].min(), num[:, 0].max()
+    return to_datetime(dat), num, bbox
+
+
+def best(func, fname, repeat):
+    times = []
+    for _ in range(repeat):
+        t = time.perf_counter()
+        func(fname)
+        times.append(time.perf_counter() - t)
+    return min(times)
+
+
+if __name__ == "__main__":
+    fname = sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.path.dirname(__file__), '..', 'data',
+                                                               'GPSdata02_03.csv')
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    rows = best(load_rows, fname, repeat)
+    cols = best(load_columns, fname, repeat)
+    with open(fname, 'rb') as csvfile:
+        csvfile.readline()
+        fast = read_csv_fast(csvfile.read()) is not None
+    print(f"{os.path.basename(fname)}: строк {len(load_rows(fname)[0])}, "
+          f"{'строки одной длины - без loadtxt' if fast else 'разбор loadtxt'}")
+    print(f"построчно: {rows * 1000:.1f} мс, столбцами: {cols * 1000:.1f} мс, быстрее в {rows / cols:.1f} раз")
@@ -0,0 +1,246 @@
+# Замеры горячих мест: загрузка маршрутов, разбор GPX/KML, перевод в экранные координаты, рисование
+# маршрута и перерисовка (SDL без окна), поиск точки по клику, загрузка кусков карты с заглушки-сервера.
+# Маршруты - из data/ и gpx/ плюс искусственные на 10 тыс. - 1 млн точек. Итог - в JSON, чтобы сравнивать версии
+# запуск: python benchmarks/bench_suite.py [--sizes 10000,100000,1000000] [--latency 50] [--json bench_results.json]
+import os
+import sys
+import io
+import json
+import time
+import glob
+import shutil
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+os.environ['SDL_VIDEODRIVER'] = 'dummy'
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+import numpy as np  # noqa: E402
+import pygame  # noqa: E402
+import Map_route as M  # noqa: E402
+
+
+# время <func> в мс: лучшее, среднее и медиана из <repeat> запусков; <setup> - перед каждым, не считается
+def measure(func, repeat, setup=None):
+    times = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        t = time.perf_counter()
+        func()
+        times.append((time.perf_counter() - t) * 1000)
+    return {'best_ms': min(times), 'mean_ms': float(np.mean(times)), 'median_ms': float(np.median(times)),
+            'repeat': repeat}
+
+
+# Заглушка сервера кусков карты: одна и та же картинка с задержкой <latency> мс
+class StubTiles:
+    def __init__(self, latency):
+        surface = pygame.Surface((M.TILE, M.TILE))
+        surface.fill((200, 220, 240))
+        buf = io.BytesIO()
+        pygame.image.save(surface, buf, 'tile.png')
+        png = buf.getvalue()
+        self.requests = 0
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                stub.requests += 1
+                time.sleep(latency / 1000)
+                self.send_response(200)
+                self.send_header('Content-Type', 'image/png')
+                self.send_header('Content-Length', str(len(png)))
+                self.end_headers()
+                self.wfile.write(png)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_port}/{{z}}/{{x}}/{{y}}.png"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+
+# искусственный маршрут: случайное блуждание с шагом около 10 м, точка в секунду - в CSV и в GPX
+def synthetic_track(n, path):
+    rng = np.random.default_rng(n)
+    heading = np.cumsum(rng.normal(0, 0.2, n))
+    lat = 46.3 + np.cumsum(np.cos(heading)) * 9e-5
+    lon = 44.27 + np.cumsum(np.sin(heading)) * 1.3e-4
+    times = np.datetime64('2019-11-02T09:00:00') + np.arange(n).astype('timedelta64[s]')
+    stamps = np.datetime_as_string(times)
+    dist = np.concatenate(([0], np.cumsum(M.distances(lat, lon) * 1000))).astype(int)
+    csv_name = os.path.join(path, f"synthetic_{n}.csv")
+    with open(csv_name, 'w') as f:
+        f.write('DAT;LAT;LON;SPD;Metr\n')
+        f.writelines(f"{t[:10].replace('-', '.')} {t[11:]};{y:.6f};{x:.6f};36,0;{d}\n"
+                     for t, y, x, d in zip(stamps, lat, lon, dist))
+    gpx_name = os.path.join(path, f"synthetic_{n}.gpx")
+    with open(gpx_name, 'w') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<gpx version="1.1" xmlns="http://www.topografix.com/GPX/1/1"><trk><trkseg>\n')
+        f.writelines(f'<trkpt lat="{y:.7f}" lon="{x:.7f}"><ele>100.0</ele><time>{t}Z</time></trkpt>\n'
+                     for t, y, x in zip(stamps, lat, lon))
+        f.write('</trkseg></trk></gpx>\n')
+    return csv_name, gpx_name
+
+
+# глобальные объекты окна Map_route, как в его __main__, но с SDL без окна
+def setup_window(tmp, stub):
+    pygame.init()
+    M.screen = pygame.display.set_mode((1200, 900))
+    M.all_sprites = pygame.sprite.Group()
+    M.tile_cache = M.TileCache(os.path.join(tmp, 'tiles'))
+    M.surface_pool = M.SurfacePool()
+    M.tiles = M.make_tiles(stub.url)
+    M.prefetcher = M.Prefetcher()
+    M.prefetcher.schedule = lambda mp: None  # соседние виды не подгружаем - мешали бы замерам
+    M.tile_loader = M.TileLoader()
+    M.mp = M.Map()
+    M.routes = M.Routes()
+    M.layers = M.Layers()
+
+
+def bench_track(fname, repeat, results):
+    name = os.path.basename(fname)
+    cache = M.route_cache_name(fname)
+
+    def drop_cache():
+        if os.path.exists(cache):
+            os.remove(cache)
+
+    track = M.Track(fname)
+    if not track.isRoute:
+        return None
+    n = len(track.lon)
+    results.append({'name': 'load_route', 'track': name, 'points': n,
+                    **measure(lambda: M.Track(fname), repeat, drop_cache)})
+    results.append({'name': 'load_route_cached', 'track': name, 'points': n,
+                    **measure(lambda: M.Track(fname), repeat)})
+    if fname.lower().endswith(('.gpx', '.kml', '.xml')):
+        results.append({'name': 'read_track_xml', 'track': name, 'points': n,
+                        **measure(lambda: sum(1 for _ in M.read_track_xml(fname)), repeat)})
+    mp = M.Map()
+    M.fit_map(mp, *track.bbox)
+    results.append({'name': 'geo_to_screen', 'track': name, 'points': n,
+                    **measure(lambda: mp.geo_to_screen_arr(track.lon, track.lat), repeat)})
+    return track
+
+
+# вид <mp> на экране, и все его куски карты уже загружены
+def settle(mp):
+    M.load_4picture(mp)
+    for job in list(M.tile_loader.jobs.values()):
+        job.result()
+    pygame.event.clear()
+
+
+# рисование маршрута и перерисовка окна (куски карты уже в кэше), поиск точки по клику
+def bench_window(fname, repeat, results):
+    name = os.path.basename(fname)
+    M.routes.load([fname])
+    mp = M.mp
+    route = M.routes.items[0]
+    n = len(route.lon)
+
+    def invalidate():
+        M.layers.overlay_key = None
+        M.layers.overlay.fill((0, 0, 0, 0))
+
+    def invalidate_all():
+        invalidate()
+        M.layers.base_key = None
+
+    for zoom in (mp.zoom, min(mp.zoom + 3, 19)):
+        mp.zoom = zoom
+        settle(mp)
+        results.append({'name': 'draw_route', 'track': name, 'points': n, 'zoom': zoom,
+                        **measure(lambda: M.draw_route(mp, route, M.layers.overlay), repeat, invalidate)})
+        results.append({'name': 'redraw', 'track': name, 'points': n, 'zoom': zoom,
+                        **measure(lambda: M.load_4picture(mp), repeat, invalidate)})
+        # возврат к уже виденному виду: и карта из кусков собирается заново
+        results.append({'name': 'redraw_view', 'track': name, 'points': n, 'zoom': zoom,
+                        **measure(lambda: M.load_4picture(mp), repeat, invalidate_all)})
+    rng = np.random.default_rng(0)
+    xs, ys = M.mp.geo_to_screen_arr(route.lon, route.lat)
+    pick = rng.integers(0, n, 1000)
+    clicks = list(zip((xs[pick] + rng.integers(-3, 4, 1000)).tolist(), (ys[pick] + rng.integers(-3, 4, 1000)).tolist()))
+    timing = measure(lambda: [M.routes.nearest(mp, pos, M.CLICK_RADIUS) for pos in clicks], repeat)
+    results.append({'name': 'click_lookup', 'track': name, 'points': n, 'clicks': len(clicks),
+                    'per_click_us': timing['best_ms'] * 1000 / len(clicks), **timing})
+
+
+# куски одного вида: с пустым кэшем (все с сервера-заглушки, параллельно) и из кэша в памяти
+def bench_tiles(stub, latency, repeat, results):
+    mp = M.Map()
+    mp.lat, mp.lon = 46.30774, 44.26976
+    views = mp.tiles()
+
+    def fetch_all():
+        jobs = [M.map_pool.submit(M.load_map, M.tiles, z, x, y) for z, x, y, _, _ in views]
+        return [job.result() for job in jobs]
+
+    def fresh_cache():
+        shutil.rmtree(M.tile_cache.path, ignore_errors=True)
+        M.tile_cache = M.TileCache(M.tile_cache.path)
+
+    requests_before = stub.requests
+    cold = measure(fetch_all, repeat, fresh_cache)
+    results.append({'name': 'tiles_cold', 'tiles': len(views), 'latency_ms': latency,
+                    'requests': stub.requests - requests_before, **cold})
+    results.append({'name': 'tiles_warm', 'tiles': len(views), 'latency_ms': latency, **measure(fetch_all, repeat)})
+
+
+def meta():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                                text=True).stdout.strip()
+    except OSError:
+        commit = ''
+    return {'commit': commit, 'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(),
+            'numpy': np.__version__, 'pygame': pygame.version.ver, 'platform': platform.platform(),
+            'cpus': os.cpu_count()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Замеры горячих мест Map_route')
+    parser.add_argument('--sizes', default='10000,100000,1000000', help='точек в искусственных маршрутах')
+    parser.add_argument('--latency', type=float, default=50, help='задержка заглушки кусков карты, мс')
+    parser.add_argument('--repeat', type=int, default=5, help='повторов каждого замера')
+    parser.add_argument('--json', default='bench_results.json', help='куда записать итог')
+    parser.add_argument('--no-samples', action='store_true', help='без маршрутов из data/ и gpx/')
+    args = parser.parse_args()
+    os.chdir(ROOT)  # картинки и шрифты - относительно каталога программы
+    tmp = tempfile.mkdtemp(prefix='map_route_bench_')
+    M.ROUTE_CACHE_DIR = os.path.join(tmp, 'routes')  # двоичные копии маршрутов - тоже во временном каталоге
+    stub = StubTiles(args.latency)
+    setup_window(tmp, stub)
+    fnames = [] if args.no_samples else sorted(glob.glob(os.path.join('data', '*')) + glob.glob(os.path.join('gpx', '*')))
+    for n in (int(size) for size in args.sizes.split(',') if size):
+        fnames += synthetic_track(n, tmp)
+    results = []
+    try:
+        for fname in fnames:
+            track = bench_track(fname, args.repeat, results)
+            if track is not None:
+                bench_window(fname, args.repeat, results)
+            print(f"{os.path.basename(fname)}: готово", file=sys.stderr)
+        bench_tiles(stub, args.latency, args.repeat, results)
+    finally:
+        stub.server.shutdown()
+        shutil.rmtree(tmp, ignore_errors=True)
+    for r in results:
+        label = r['name'] + (f" [{r['track']}]" if 'track' in r else '') + (f" z{r['zoom']}" if 'zoom' in r else '')
+        print(f"{label:70s} {r['best_ms']:10.3f} мс")
+    with open(args.json, 'w', encoding='utf-8') as f:
+        json.dump({'meta': meta(), 'results': results}, f, ensure_ascii=False, indent=1)
+    print('Итог записан в', args.json)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+# Проверка геокодера на локальной заглушке сервера (без сети и ключа): объединение одинаковых запросов,
+# ограничение частоты, запоминание ответов на диске между запусками и испорченный файл адресов
+# запуск: python benchmarks/check_geocoder.py [--latency 200] [--rate 5]
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import threading
+from urllib.parse import urlsplit, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import Map_route as M  # noqa: E402
+
+
+# Заглушка геокодера: ответ в формате Яндекса с задержкой <latency> мс; помнит все запросы
+class StubGeocoder:
+    def __init__(self, latency):
+        self.queries = []
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                query = parse_qs(urlsplit(self.path).query)['geocode'][0]
+                stub.queries.append(query)
+                time.sleep(latency / 1000)
+                geo = {"metaDataProperty": {"GeocoderMetaData": {"text": f"адрес {query}"}},
+                       "Point": {"pos": "44.26976 46.30774"}}
+                body = json.dumps({"response": {"GeoObjectCollection": {"featureMember": [{"GeoObject": geo}]}}})
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.end_headers()
+                self.wfile.write(body.encode())
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_port}/1.x/"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+
+def check(name, ok, detail=''):
+    print(('ok    ' if ok else 'ОШИБКА') + f" {name} {detail}")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Проверка геокодера Map_route на заглушке сервера')
+    parser.add_argument('--latency', type=float, default=200, help='задержка ответа заглушки, мс')
+    parser.add_argument('--rate', type=float, default=5, help='запросов в секунду (GEOCODER_RATE)')
+    args = parser.parse_args()
+    stub = StubGeocoder(args.latency)
+    path = os.path.join(tempfile.mkdtemp(prefix='map_route_geo_'), 'geocode.json')
+    results = []
+
+    # одинаковые одновременные запросы - один запрос к серверу, один и тот же Future
+    geocoder = M.Geocoder(url=stub.url, rate=args.rate, path=path)
+    futures = [geocoder.reverse(44.26976, 46.30774) for _ in range(10)]
+    answers = {future.result() for future in futures}
+    results.append(check('объединение', len(stub.queries) == 1 and len(answers) == 1,
+                         f"(запросов к серверу {len(stub.queries)} на 10 одинаковых)"))
+
+    # разные запросы сверх запаса ведра ждут жетонов: не чаще <rate> в секунду
+    n = int(args.rate) * 3
+    stub.queries.clear()
+    started = time.monotonic()
+    for future in [geocoder.reverse(44.0 + i / 100, 46.0) for i in range(n)]:
+        future.result()
+    elapsed = time.monotonic() - started
+    least = (n - geocoder.bucket.capacity) / args.rate
+    results.append(check('частота', len(stub.queries) == n and elapsed >= least * 0.95,
+                         f"({n} запросов за {elapsed:.2f} с, не меньше {least:.2f} с)"))
+
+    # ответы переживают перезапуск: новый геокодер отвечает из файла, к серверу не обращаясь
+    geocoder.close()
+    stub.queries.clear()
+    geocoder = M.Geocoder(url=stub.url, rate=args.rate, path=path)
+    address = geocoder.reverse(44.26976, 46.30774).result()
+    results.append(check('запоминание', not stub.queries and address == 'адрес 44.26976,46.30774',
+                         f"(запросов к серверу {len(stub.queries)}, {geocoder.stats()})"))
+    geocoder.close()
+
+    # файл верного JSON, но не того вида, не мешает запуску
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({"a": [1, 2]}, f)
+    geocoder = M.Geocoder(url=stub.url, rate=args.rate, path=path)
+    results.append(check('испорченный файл', not geocoder.cache, f"(в памяти {len(geocoder.cache)})"))
+    geocoder.close()
+
+    stub.server.shutdown()
+    return all(results)
+
+
+if __name__ == "__main__":
+    sys.exit(0 if main() else 1)